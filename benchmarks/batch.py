@@ -0,0 +1,77 @@
+#!/usr/bin/python3
+"""Deliver spooled results to the stand-in gateway with and without the
+batch endpoint and compare the number of requests each mode needs."""
+
+import argparse
+import os
+import sys
+from tempfile import mkdtemp
+from time import monotonic
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from benchmarks.gateway import StandInGateway, make_sota_dir  # noqa: E402
+from fiotest.api import API  # noqa: E402
+from fiotest.spool import Spool, SpoolFlusher  # noqa: E402
+
+
+def deliver(workdir: str, sota_dir: str, tests: int, batch: bool) -> dict:
+    gateway = StandInGateway(sota_dir, batch=batch)
+    gateway.start()
+    try:
+        spool = Spool(os.path.join(workdir, "spool-%s" % batch))
+        for i in range(tests):
+            artifacts = os.path.join(workdir, "artifacts-%s-%d" % (batch, i))
+            os.mkdir(artifacts)
+            with open(os.path.join(artifacts, "console.log"), "w") as f:
+                f.write("test %d output\n" % i)
+            data = {"results": [{"name": "case", "status": "PASSED"}]}
+            spool.add("test-%d" % i, "stand-in-1", data, artifacts)
+
+        api = API(sota_dir, False)
+        flusher = SpoolFlusher(spool, api, batch=tests)
+        start = monotonic()
+        flusher.flush()
+        elapsed = monotonic() - start
+        if spool.pending_ids():
+            sys.exit("Spooled results were not all delivered")
+        stats = dict(gateway.stats, seconds=elapsed)
+        stats["requests"] = sum(
+            stats.get(k, 0) for k in ("start", "complete", "batch", "upload")
+        )
+        return stats
+    finally:
+        gateway.shutdown()
+        gateway.server_close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--tests", type=int, default=40)
+    args = parser.parse_args()
+
+    workdir = mkdtemp(prefix="fiotest-bench-")
+    # the gateway client keeps its breaker and pacing state in here
+    os.environ["FIO_TEST_DIR"] = workdir
+    sota_dir = os.path.join(workdir, "sota")
+    make_sota_dir(sota_dir)
+    for batch in (False, True):
+        stats = deliver(workdir, sota_dir, args.tests, batch)
+        print(
+            "%-10s %d tests: %d requests (%d start, %d complete, %d batch, "
+            "%d upload) in %.2fs"
+            % (
+                "batched" if batch else "per-test",
+                args.tests,
+                stats["requests"],
+                stats.get("start", 0),
+                stats.get("complete", 0),
+                stats.get("batch", 0),
+                stats.get("upload", 0),
+                stats["seconds"],
+            )
+        )
+
+
+if __name__ == "__main__":
+    main()
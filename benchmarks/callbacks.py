@@ -0,0 +1,135 @@
+#!/usr/bin/python3
+"""Fire aktualizr-lite callbacks at a CallbackServer and measure how long
+each one takes to be acknowledged, including while the handler is busy."""
+
+import argparse
+from concurrent.futures import ThreadPoolExecutor
+from http.client import HTTPConnection
+import json
+import os
+import socket
+import sys
+from threading import Thread
+from time import monotonic, sleep
+from typing import List
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from fiotest.callbacks import AktualizrCallbackHandler, CallbackServer  # noqa: E402
+
+
+class SlowHandler(AktualizrCallbackHandler):
+    """Takes `seconds` to handle each callback, like a Coordinator that is
+       stopping or starting a SpecRunner."""
+
+    def __init__(self, seconds: float):
+        self.seconds = seconds
+
+    def on_install_pre(self, current_target: str):
+        sleep(self.seconds)
+
+    def on_install_post(self, current_target: str, status: str):
+        sleep(self.seconds)
+
+    def on_check_for_updates_pre(self, current_target: str):
+        sleep(self.seconds)
+
+
+def _free_port() -> int:
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def _percentile(samples: List[float], pct: float) -> float:
+    ordered = sorted(samples)
+    return ordered[min(len(ordered) - 1, int(len(ordered) * pct / 100))]
+
+
+def post(port: int, body: str) -> float:
+    """Send one callback the way aklite-callback.sh does and return the
+       seconds it took to be acknowledged."""
+    start = monotonic()
+    conn = HTTPConnection("127.0.0.1", port, timeout=30)
+    try:
+        conn.request("POST", "/", body.encode())
+        r = conn.getresponse()
+        r.read()
+        if r.status != 201:
+            raise RuntimeError("Callback failed: HTTP_%d" % r.status)
+    finally:
+        conn.close()
+    return monotonic() - start
+
+
+def generate(port: int, count: int, concurrency: int) -> List[float]:
+    """Send `count` callbacks from `concurrency` clients at once. Returns the
+       ack latency of each."""
+    bodies = ["check-for-update-pre,stand-in-%d" % i for i in range(count)]
+    with ThreadPoolExecutor(concurrency) as pool:
+        return list(pool.map(lambda b: post(port, b), bodies))
+
+
+def server_metrics(port: int) -> dict:
+    conn = HTTPConnection("127.0.0.1", port, timeout=30)
+    try:
+        conn.request("GET", "/metrics")
+        return json.loads(conn.getresponse().read())
+    finally:
+        conn.close()
+
+
+def start_server(handler_seconds: float) -> CallbackServer:
+    server = CallbackServer(SlowHandler(handler_seconds), _free_port())
+    Thread(target=server.run_forever, daemon=True).start()
+    while True:
+        try:
+            server_metrics(server.port)
+            return server
+        except ConnectionRefusedError:
+            sleep(0.05)
+
+
+def run(count: int, concurrency: int, handler_seconds: float) -> dict:
+    server = start_server(handler_seconds)
+    start = monotonic()
+    latencies = generate(server.port, count, concurrency)
+    elapsed = monotonic() - start
+    return {
+        "callbacks": count,
+        "seconds": elapsed,
+        "ack_p50": _percentile(latencies, 50),
+        "ack_p99": _percentile(latencies, 99),
+        "ack_max": max(latencies),
+        "queued": server_metrics(server.port)["queued"],
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--callbacks", type=int, default=500)
+    parser.add_argument("--concurrency", type=int, default=8)
+    parser.add_argument(
+        "--handler-seconds",
+        type=float,
+        default=0.01,
+        help="Time the handler spends on each callback",
+    )
+    args = parser.parse_args()
+    stats = run(args.callbacks, args.concurrency, args.handler_seconds)
+    print(
+        "%d callbacks in %.2fs: ack p50 %.1fms p99 %.1fms max %.1fms, "
+        "%d still queued for the handler"
+        % (
+            stats["callbacks"],
+            stats["seconds"],
+            stats["ack_p50"] * 1000,
+            stats["ack_p99"] * 1000,
+            stats["ack_max"] * 1000,
+            stats["queued"],
+        )
+    )
+
+
+if __name__ == "__main__":
+    main()
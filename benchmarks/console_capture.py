@@ -0,0 +1,68 @@
+#!/usr/bin/python3
+"""Compare the throughput of fio-test-wrap's console capture with the
+line-by-line loop it replaced."""
+
+import argparse
+import os
+import subprocess
+import sys
+from tempfile import TemporaryDirectory
+from time import monotonic
+from typing import List
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from fiotest.console import ConsoleCapture  # noqa: E402
+
+
+def _producer(megabytes: int, line_len: int) -> List[str]:
+    line = "x" * (line_len - 1)
+    size = megabytes * 1024 * 1024
+    return ["sh", "-c", "yes %s | head -c %d" % (line, size)]
+
+
+def line_loop(cmd: List[str], console: str, mirror) -> None:
+    last_lines = [b""] * 20
+    i = 0
+    with open(console, "wb") as consolefd:
+        p = subprocess.Popen(cmd, stderr=subprocess.STDOUT, stdout=subprocess.PIPE)
+        assert p.stdout
+        for line in p.stdout:
+            mirror.write(b"| ")
+            mirror.write(line)
+            mirror.flush()
+            consolefd.write(line)
+            last_lines[i % 20] = line
+            i += 1
+        p.wait()
+
+
+def chunked(cmd: List[str], console: str, mirror) -> None:
+    with open(console, "wb") as consolefd:
+        p = subprocess.Popen(cmd, stderr=subprocess.STDOUT, stdout=subprocess.PIPE)
+        assert p.stdout
+        ConsoleCapture(consolefd, mirror).run(p.stdout.fileno())
+        p.wait()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--megabytes", type=int, default=200)
+    parser.add_argument("--line-length", type=int, default=80)
+    args = parser.parse_args()
+
+    cmd = _producer(args.megabytes, args.line_length)
+    with TemporaryDirectory() as tmp, open(os.devnull, "wb") as mirror:
+        console = os.path.join(tmp, "console.log")
+        for name, capture in (("line loop", line_loop), ("chunked", chunked)):
+            start = monotonic()
+            capture(cmd, console, mirror)
+            elapsed = monotonic() - start
+            print(
+                "%-10s %d MB in %.2fs: %.1f MB/s"
+                % (name, args.megabytes, elapsed, args.megabytes / elapsed)
+            )
+
+
+if __name__ == "__main__":
+    main()
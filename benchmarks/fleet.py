@@ -0,0 +1,171 @@
+#!/usr/bin/python3
+"""Simulate a fleet of devices reporting tests to the stand-in gateway
+right after a Target is rolled out to all of them, with and without
+fiotest's kickoff spread.
+
+Each simulated device waits out the kickoff delay fiotest would give it,
+then starts a test, completes it and uploads an artifact. Like
+DeviceGatewayClient, it backs off with jitter on a 429 or 503 and honors
+Retry-After. The gateway's capacity is modelled with its throttle. The
+report shows the gateway's peak request rate, how many requests it turned
+away and how long devices took to report."""
+
+import argparse
+from concurrent.futures import ThreadPoolExecutor
+from http.client import HTTPSConnection
+import json
+import os
+from random import uniform
+import ssl
+import sys
+from tempfile import mkdtemp
+from time import monotonic, sleep
+from typing import Dict, List, Tuple
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from benchmarks.gateway import StandInGateway, make_sota_dir  # noqa: E402
+from fiotest.pacing import kickoff_delay  # noqa: E402
+
+TARGET = "stand-in-fleet-1"
+
+
+def _percentile(samples: List[float], pct: float) -> float:
+    ordered = sorted(samples)
+    return ordered[min(len(ordered) - 1, int(len(ordered) * pct / 100))]
+
+
+class Device:
+    def __init__(self, ctx: ssl.SSLContext, port: int, artifact: bytes):
+        self.conn = HTTPSConnection("localhost", port, context=ctx, timeout=60)
+        self.artifact = artifact
+        self.rejected = 0
+
+    def _request(self, method: str, path: str, body: bytes) -> Tuple[int, bytes]:
+        delay = 0.0
+        for _ in range(6):
+            try:
+                self.conn.request(method, path, body)
+                r = self.conn.getresponse()
+                data = r.read()
+            except OSError:
+                self.conn.close()
+                status, data, retry_after = 0, b"", None
+            else:
+                status, retry_after = r.status, r.getheader("Retry-After")
+            if status not in (0, 429, 503):
+                return status, data
+            self.rejected += 1
+            delay = min(16.0, uniform(1.0, max(1.0, delay * 3)))
+            if retry_after:
+                delay = max(delay, float(retry_after))
+            sleep(delay)
+        return status, data
+
+    def report(self) -> bool:
+        """Start, complete and upload the artifact of one test."""
+        status, test_id = self._request("POST", "/tests", b'{"name": "fleet"}')
+        if status != 201:
+            return False
+        path = "/tests/" + test_id.decode()
+        status, _ = self._request("PUT", path, b'{"artifacts": ["a.bin"]}')
+        if status != 200:
+            return False
+        status, _ = self._request("PUT", path + "/a.bin", self.artifact)
+        self.conn.close()
+        return status == 200
+
+
+def simulate(
+    gateway: StandInGateway,
+    ctx: ssl.SSLContext,
+    devices: int,
+    spread: int,
+    artifact: bytes,
+    concurrency: int,
+) -> Dict[str, float]:
+    gateway.reset_stats()
+    delays = sorted(
+        kickoff_delay(b"device-%d" % i, TARGET, spread) for i in range(devices)
+    )
+    start = monotonic()
+
+    def run(due: float) -> Tuple[float, bool, int]:
+        kickoff = start + due
+        device = Device(ctx, gateway.server_port, artifact)
+        ok = device.report()
+        return monotonic() - kickoff, ok, device.rejected
+
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        futures = []
+        for due in delays:
+            sleep(max(0, start + due - monotonic()))
+            futures.append(executor.submit(run, due))
+        results = [f.result() for f in futures]
+    latencies = [r[0] for r in results]
+    return {
+        "devices": devices,
+        "spread": spread,
+        "seconds": monotonic() - start,
+        "peak_rps": gateway.peak_rps,
+        "rejected": sum(r[2] for r in results),
+        "failed_devices": sum(1 for r in results if not r[1]),
+        "report_p50": _percentile(latencies, 50),
+        "report_p99": _percentile(latencies, 99),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--devices", type=int, default=300)
+    parser.add_argument(
+        "--spread", type=int, default=30, help="Kickoff spread in seconds"
+    )
+    parser.add_argument(
+        "--throttle", type=float, default=50, help="Gateway requests per second"
+    )
+    parser.add_argument("--artifact-kb", type=int, default=64)
+    parser.add_argument("--concurrency", type=int, default=200)
+    parser.add_argument("--json", action="store_true", help="Print results as JSON")
+    args = parser.parse_args()
+
+    sota_dir = os.path.join(mkdtemp(prefix="fiotest-fleet-"), "sota")
+    make_sota_dir(sota_dir, TARGET)
+    gateway = StandInGateway(sota_dir, throttle=args.throttle)
+    gateway.start()
+    ctx = ssl.create_default_context(cafile=os.path.join(sota_dir, "root.crt"))
+    ctx.load_cert_chain(
+        os.path.join(sota_dir, "client.pem"), os.path.join(sota_dir, "pkey.pem")
+    )
+    artifact = os.urandom(args.artifact_kb * 1024)
+    try:
+        runs = [
+            simulate(gateway, ctx, args.devices, spread, artifact, args.concurrency)
+            for spread in (0, args.spread)
+        ]
+    finally:
+        gateway.shutdown()
+        gateway.server_close()
+
+    if args.json:
+        print(json.dumps(runs, indent=2))
+        return
+    header = ("spread", "seconds", "peak rps", "rejected", "failed", "p50", "p99")
+    print("%-8s %8s %8s %9s %8s %10s %10s" % header)
+    for r in runs:
+        print(
+            "%-8s %8.1f %8d %9d %8d %9.2fs %9.2fs"
+            % (
+                "%ds" % r["spread"],
+                r["seconds"],
+                r["peak_rps"],
+                r["rejected"],
+                r["failed_devices"],
+                r["report_p50"],
+                r["report_p99"],
+            )
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,337 @@
+#!/usr/bin/python3
+"""A local stand-in for the device gateway's /tests API.
+
+It implements enough of the protocol fiotest uses (start, complete,
+artifact upload and batched completion) to exercise fiotest.api without a
+real Factory. `make_sota_dir` creates a throwaway CA and client
+certificate so DeviceGatewayClient can talk to it using mutual TLS.
+
+To see how fiotest copes with a struggling gateway, requests can be
+delayed, failed at random with a 503 or throttled with a 429 once they
+exceed a rate.
+
+Artifacts can also be uploaded in ranges with Content-Range. Unfinished
+uploads are answered with a 308 and the range received so far, and a PUT
+with "Content-Range: bytes */<size>" asks for it, so interrupted uploads
+can be resumed. Ranges of an upload whose size isn't known yet, "bytes
+<start>-<end>/*", are taken too. That is how a running test's console.log
+is streamed.
+"""
+
+import argparse
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import json
+import os
+from random import random
+import ssl
+import subprocess
+from threading import Lock, Thread
+from time import monotonic, sleep
+from typing import Dict, List
+from uuid import uuid4
+
+
+def _openssl(cmd: str, cwd: str):
+    subprocess.check_call(
+        ["openssl"] + cmd.split(),
+        cwd=cwd,
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.DEVNULL,
+    )
+
+
+def make_sota_dir(sota_dir: str, target: str = "stand-in-1"):
+    """Populate `sota_dir` with the certificates and current-target that
+       DeviceGatewayClient and API need. StandInGateway adds sota.toml."""
+    os.makedirs(sota_dir, exist_ok=True)
+    with open(os.path.join(sota_dir, "server.ext"), "w") as f:
+        f.write("subjectAltName=DNS:localhost,IP:127.0.0.1\n")
+    _openssl(
+        "req -x509 -newkey rsa:2048 -nodes -days 30 -keyout ca.key -out root.crt "
+        "-subj /CN=stand-in-ca",
+        sota_dir,
+    )
+    for name, cn, key, cert in (
+        ("server", "localhost", "server.key", "server.crt"),
+        ("client", "stand-in-device", "pkey.pem", "client.pem"),
+    ):
+        _openssl(
+            "req -newkey rsa:2048 -nodes -keyout %s -out %s.csr -subj /CN=%s"
+            % (key, name, cn),
+            sota_dir,
+        )
+        _openssl(
+            "x509 -req -in %s.csr -CA root.crt -CAkey ca.key -CAcreateserial "
+            "-days 30 -out %s -extfile server.ext" % (name, cert),
+            sota_dir,
+        )
+    with open(os.path.join(sota_dir, "current-target"), "w") as f:
+        f.write('TARGET_NAME="%s"\n' % target)
+
+
+class TokenBucket:
+    """Allows `rate` requests per second with bursts of up to `rate`."""
+
+    def __init__(self, rate: float):
+        self.rate = rate
+        self.tokens = rate
+        self._last = monotonic()
+        self._lock = Lock()
+
+    def take(self) -> bool:
+        with self._lock:
+            now = monotonic()
+            self.tokens = min(self.rate, self.tokens + (now - self._last) * self.rate)
+            self._last = now
+            if self.tokens < 1:
+                return False
+            self.tokens -= 1
+            return True
+
+
+class Handler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    server: "StandInGateway"
+
+    def log_message(self, format, *args):
+        if self.server.verbose:
+            super().log_message(format, *args)
+
+    def _body(self) -> bytes:
+        if self.headers.get("Transfer-Encoding", "").lower() == "chunked":
+            chunks: List[bytes] = []
+            while True:
+                size = int(self.rfile.readline().strip(), 16)
+                if size == 0:
+                    self.rfile.readline()
+                    return b"".join(chunks)
+                chunks.append(self.rfile.read(size))
+                self.rfile.readline()
+        return self.rfile.read(int(self.headers.get("Content-Length", 0)))
+
+    def _reply(self, code: int, body: str = "", content_type: str = "text/plain"):
+        data = body.encode()
+        self.send_response(code)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def _admit(self) -> bool:
+        """Apply the configured latency, throttling and errors. Returns False
+           if the request has already been answered with an error."""
+        server = self.server
+        server.count("requests")
+        server.tick()
+        if server.latency:
+            sleep(server.latency)
+        if server.bucket and not server.bucket.take():
+            server.count("throttled")
+            self.send_response(429)
+            self.send_header("Retry-After", "1")
+            self.send_header("Content-Length", "0")
+            self.end_headers()
+            return False
+        if server.error_rate and random() < server.error_rate:
+            server.count("errors")
+            self._reply(503, "stand-in gateway error\n")
+            return False
+        return True
+
+    def _artifact_urls(self, test_id: str, artifacts) -> Dict[str, dict]:
+        base = "https://localhost:%d/tests/%s/" % (self.server.server_port, test_id)
+        return {
+            a: {"url": base + a, "content-type": "application/octet-stream"}
+            for a in artifacts or []
+        }
+
+    def do_GET(self):
+        if self.path == "/stats":
+            self._reply(200, json.dumps(self.server.stats), "application/json")
+        else:
+            self._reply(404)
+
+    def do_POST(self):
+        body = self._body()
+        if not self._admit():
+            return
+        if self.path == "/tests":
+            self.server.count("start")
+            self._reply(201, str(uuid4()))
+        elif self.path == "/tests/batch" and self.server.batch:
+            self.server.count("batch")
+            tests = json.loads(body)["tests"]
+            self.server.count("batched_tests", len(tests))
+            created = []
+            for test in tests:
+                test_id = str(uuid4())
+                urls = self._artifact_urls(test_id, test.get("artifacts"))
+                created.append({"id": test_id, "artifacts": urls})
+            self._reply(201, json.dumps({"tests": created}), "application/json")
+        else:
+            self._reply(404)
+
+    def do_PUT(self):
+        body = self._body()
+        if not self._admit():
+            return
+        parts = self.path.strip("/").split("/")
+        if len(parts) == 2 and parts[0] == "tests":
+            self.server.count("complete")
+            test = json.loads(body)
+            urls = self._artifact_urls(parts[1], test.get("artifacts"))
+            self._reply(200, json.dumps(urls), "application/json")
+        elif len(parts) == 3 and parts[0] == "tests":
+            content_range = self.headers.get("Content-Range")
+            if content_range and self.server.ranged:
+                self._put_range(content_range, body)
+                return
+            self.server.count("upload")
+            self.server.count("upload_bytes", len(body))
+            self._reply(200)
+        else:
+            self._reply(404)
+
+    def _put_range(self, content_range: str, body: bytes):
+        server = self.server
+        received, size = content_range.split(" ", 1)[1].split("/")
+        total = float("inf") if size == "*" else int(size)
+        with server.uploads_lock:
+            have = server.uploads.get(self.path, 0)
+            if received == "*":
+                server.count("ranged_queries")
+                if 0 < have < total:
+                    server.count("resumed_bytes", have)
+            elif int(received.split("-")[0]) == have and have < total:
+                have += len(body)
+                server.uploads[self.path] = have
+                server.count("chunks")
+                server.count("upload_bytes", len(body))
+                if size == "*":
+                    server.count("streamed_bytes", len(body))
+                if have >= total:
+                    server.count("upload")
+        if have >= total:
+            self._reply(200)
+            return
+        self.send_response(308)
+        if have:
+            self.send_header("Range", "bytes=0-%d" % (have - 1))
+        self.send_header("Content-Length", "0")
+        self.end_headers()
+
+
+class StandInGateway(ThreadingHTTPServer):
+    daemon_threads = True
+    request_queue_size = 1024  # room for a simulated fleet connecting at once
+
+    def __init__(
+        self,
+        sota_dir: str,
+        port: int = 0,
+        batch: bool = True,
+        latency: float = 0,
+        error_rate: float = 0,
+        throttle: float = 0,
+        ranged: bool = True,
+    ):
+        """`latency` is added to every request, a fraction `error_rate` of
+           them fail with a 503 and requests beyond `throttle` per second
+           get a 429. Each of these is disabled when 0. Without `ranged`
+           the Content-Range of uploads is ignored like a plain server
+           would."""
+        super().__init__(("127.0.0.1", port), Handler)
+        ctx = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
+        ctx.load_cert_chain(
+            os.path.join(sota_dir, "server.crt"), os.path.join(sota_dir, "server.key")
+        )
+        ctx.load_verify_locations(os.path.join(sota_dir, "root.crt"))
+        ctx.verify_mode = ssl.CERT_REQUIRED
+        self.socket = ctx.wrap_socket(self.socket, server_side=True)
+        with open(os.path.join(sota_dir, "sota.toml"), "w") as f:
+            f.write('[tls]\nserver = "https://localhost:%d"\n' % self.server_port)
+            f.write('[import]\npkey_source = "file"\n')
+        self.batch = batch
+        self.latency = latency
+        self.error_rate = error_rate
+        self.bucket = TokenBucket(throttle) if throttle else None
+        self.ranged = ranged
+        # bytes received of each ranged upload
+        self.uploads: Dict[str, int] = {}
+        self.uploads_lock = Lock()
+        self.verbose = False
+        self.stats: Dict[str, int] = {}
+        # requests received in each second, to see how bursty a load is
+        self.per_second: Dict[int, int] = {}
+        self._stats_lock = Lock()
+
+    def count(self, key: str, n: int = 1):
+        with self._stats_lock:
+            self.stats[key] = self.stats.get(key, 0) + n
+
+    def tick(self):
+        second = int(monotonic())
+        with self._stats_lock:
+            self.per_second[second] = self.per_second.get(second, 0) + 1
+
+    @property
+    def peak_rps(self) -> int:
+        with self._stats_lock:
+            return max(self.per_second.values(), default=0)
+
+    def get_request(self):
+        request = super().get_request()
+        self.count("handshakes")  # the TLS handshake is done on accept
+        return request
+
+    def reset_stats(self):
+        with self._stats_lock:
+            self.stats = {}
+            self.per_second = {}
+
+    def start(self):
+        Thread(target=self.serve_forever, daemon=True).start()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--port", type=int, default=8443)
+    parser.add_argument(
+        "--sota-dir", required=True, help="Directory to create sota.toml/certs in"
+    )
+    parser.add_argument(
+        "--no-batch", action="store_true", help="Don't offer the batch endpoint"
+    )
+    parser.add_argument(
+        "--latency", type=float, default=0, help="Seconds added to each request"
+    )
+    parser.add_argument(
+        "--error-rate", type=float, default=0, help="Fraction of requests failed"
+    )
+    parser.add_argument(
+        "--throttle", type=float, default=0, help="Requests per second allowed"
+    )
+    parser.add_argument(
+        "--no-ranged", action="store_true", help="Don't offer ranged uploads"
+    )
+    parser.add_argument("--verbose", action="store_true")
+    args = parser.parse_args()
+
+    make_sota_dir(args.sota_dir)
+    gateway = StandInGateway(
+        args.sota_dir,
+        args.port,
+        not args.no_batch,
+        args.latency,
+        args.error_rate,
+        args.throttle,
+        not args.no_ranged,
+    )
+    gateway.verbose = args.verbose
+    print("Stand-in gateway listening on https://localhost:%d" % args.port)
+    print("Run fiotest with SOTA_DIR=%s" % args.sota_dir)
+    gateway.serve_forever()
+
+
+if __name__ == "__main__":
+    main()
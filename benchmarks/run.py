@@ -0,0 +1,170 @@
+#!/usr/bin/python3
+"""Run the tests of a spec through fio-test-wrap against the stand-in
+gateway and report what each one cost end to end: wall time, gateway
+requests, TLS handshakes and upload throughput. An artifact upload test
+and a burst of aktualizr-lite callbacks are measured alongside them.
+
+on_host tests and reboots need a real device and are skipped."""
+
+import argparse
+import json
+import os
+import re
+import subprocess
+import sys
+from tempfile import mkdtemp
+from time import monotonic
+from typing import Dict, List, Tuple
+
+import yaml
+
+here = os.path.dirname(os.path.abspath(__file__))
+top = os.path.dirname(here)
+sys.path.insert(0, top)
+
+from benchmarks import callbacks  # noqa: E402
+from benchmarks.gateway import StandInGateway, make_sota_dir  # noqa: E402
+from fiotest.spec import TestSpec  # noqa: E402
+
+WRAP = os.path.join(top, "bin", "fio-test-wrap")
+UPLOAD_RE = re.compile(rb"Upload of \S+: HTTP_\d+ in ([\d.]+)s")
+
+
+def spec_tests(path: str) -> List[Tuple[str, List[str]]]:
+    """Return the (name, command) of each test in the spec that can run
+       here. The spec's tests are found in this checkout."""
+    with open(path) as f:
+        spec = TestSpec.parse_obj(yaml.safe_load(f))
+    tests = []
+    for seq in spec.sequence:
+        for test in seq.tests or []:
+            if test.on_host:
+                continue
+            cmd = [
+                c.replace("/usr/share/fio-tests", os.path.join(top, "tests"))
+                for c in test.command
+            ]
+            tests.append((test.name, cmd))
+    return tests
+
+
+def run_test(
+    gateway: StandInGateway, env: dict, name: str, cmd: List[str]
+) -> Dict[str, float]:
+    gateway.reset_stats()
+    start = monotonic()
+    p = subprocess.run(
+        [sys.executable, WRAP, name] + cmd,
+        env=env,
+        stdout=subprocess.PIPE,
+        stderr=subprocess.STDOUT,
+    )
+    elapsed = monotonic() - start
+    stats = dict(gateway.stats)
+    upload_seconds = sum(float(x) for x in UPLOAD_RE.findall(p.stdout))
+    upload_bytes = stats.get("upload_bytes", 0)
+    return {
+        "seconds": elapsed,
+        "rc": p.returncode,
+        "requests": stats.get("requests", 0),
+        "handshakes": stats.get("handshakes", 0),
+        "errors": stats.get("errors", 0),
+        "throttled": stats.get("throttled", 0),
+        "resumed_bytes": stats.get("resumed_bytes", 0),
+        "upload_bytes": upload_bytes,
+        "upload_mbps": upload_bytes / upload_seconds / 1e6 if upload_seconds else 0,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument(
+        "--spec", default=os.path.join(top, "test-spec.yml"), help="Test spec YAML"
+    )
+    parser.add_argument("--iterations", type=int, default=3)
+    parser.add_argument("--artifact-mb", type=int, default=16)
+    parser.add_argument("--latency", type=float, default=0)
+    parser.add_argument("--error-rate", type=float, default=0)
+    parser.add_argument("--throttle", type=float, default=0)
+    parser.add_argument("--callbacks", type=int, default=500)
+    parser.add_argument("--json", action="store_true", help="Print results as JSON")
+    args = parser.parse_args()
+
+    workdir = mkdtemp(prefix="fiotest-bench-")
+    sota_dir = os.path.join(workdir, "sota")
+    make_sota_dir(sota_dir)
+    fiotest_dir = os.path.join(workdir, "fiotest")
+    os.mkdir(fiotest_dir)
+    env = dict(
+        os.environ,
+        PYTHONPATH=top,
+        SOTA_DIR=sota_dir,
+        FIO_TEST_DIR=fiotest_dir,
+        FIO_TEST_WORKER_SOCKET="",
+    )
+
+    tests = spec_tests(args.spec)
+    blob = "head -c %d /dev/urandom > $ARTIFACTS_DIR/blob.bin" % (
+        args.artifact_mb * 1024 * 1024
+    )
+    tests.append(("artifact upload", ["sh", "-c", blob]))
+
+    gateway = StandInGateway(
+        sota_dir,
+        latency=args.latency,
+        error_rate=args.error_rate,
+        throttle=args.throttle,
+    )
+    gateway.start()
+    results: Dict[str, List[Dict[str, float]]] = {}
+    try:
+        for _ in range(args.iterations):
+            for name, cmd in tests:
+                results.setdefault(name, []).append(run_test(gateway, env, name, cmd))
+    finally:
+        gateway.shutdown()
+        gateway.server_close()
+
+    report = {
+        "tests": {
+            name: {
+                key: sum(r[key] for r in runs) / len(runs)
+                for key in runs[0]
+                if key != "rc"
+            }
+            for name, runs in results.items()
+        },
+        "failed_runs": sum(1 for runs in results.values() for r in runs if r["rc"]),
+        "callbacks": callbacks.run(args.callbacks, 8, 0.01),
+    }
+    if args.json:
+        print(json.dumps(report, indent=2))
+        return
+
+    print(
+        "%-20s %8s %8s %10s %8s %10s"
+        % ("test", "seconds", "requests", "handshakes", "errors", "upload MB/s")
+    )
+    for name, avg in report["tests"].items():
+        print(
+            "%-20s %8.2f %8.1f %10.1f %8.1f %10.1f"
+            % (
+                name[:20],
+                avg["seconds"],
+                avg["requests"],
+                avg["handshakes"],
+                avg["errors"] + avg["throttled"],
+                avg["upload_mbps"],
+            )
+        )
+    cb = report["callbacks"]
+    print(
+        "\n%d callbacks: ack p50 %.1fms p99 %.1fms"
+        % (cb["callbacks"], cb["ack_p50"] * 1000, cb["ack_p99"] * 1000)
+    )
+    if report["failed_runs"]:
+        print("%d test runs failed" % report["failed_runs"])
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,103 @@
+#!/usr/bin/python3
+"""Measure how long fio-test-wrap takes to start a test when it starts cold
+and when it hands the test to a resident worker. Every run reports a
+trivial test to the stand-in gateway."""
+
+import argparse
+import os
+import subprocess
+import sys
+from tempfile import mkdtemp
+from time import monotonic, sleep, time
+
+here = os.path.dirname(os.path.abspath(__file__))
+top = os.path.dirname(here)
+sys.path.insert(0, top)
+
+from benchmarks.gateway import StandInGateway, make_sota_dir  # noqa: E402
+
+WRAP = os.path.join(top, "bin", "fio-test-wrap")
+
+
+def _percentile(samples, pct):
+    ordered = sorted(samples)
+    return ordered[min(len(ordered) - 1, int(len(ordered) * pct / 100))]
+
+
+def measure(env: dict, workdir: str, runs: int):
+    """Return the (startup, total) seconds of each run. Startup is the time
+       from launching fio-test-wrap until the test's command is running."""
+    marker = os.path.join(workdir, "started")
+    test = "date +%s.%N > " + marker
+    samples = []
+    for _ in range(runs):
+        launched = time()
+        start = monotonic()
+        subprocess.check_call(
+            [sys.executable, WRAP, "startup", "sh", "-c", test],
+            env=env,
+            stdout=subprocess.DEVNULL,
+        )
+        total = monotonic() - start
+        with open(marker) as f:
+            samples.append((float(f.read()) - launched, total))
+    return samples
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--runs", type=int, default=20)
+    args = parser.parse_args()
+
+    workdir = mkdtemp(prefix="fiotest-bench-")
+    sota_dir = os.path.join(workdir, "sota")
+    make_sota_dir(sota_dir)
+    fiotest_dir = os.path.join(workdir, "fiotest")
+    os.mkdir(fiotest_dir)
+    sock = os.path.join(workdir, "wrap.sock")
+    env = dict(
+        os.environ,
+        PYTHONPATH=top,
+        SOTA_DIR=sota_dir,
+        FIO_TEST_DIR=fiotest_dir,
+        FIO_TEST_WORKER_SOCKET="",
+    )
+
+    gateway = StandInGateway(sota_dir)
+    gateway.start()
+    worker = None
+    try:
+        results = {"cold": measure(env, workdir, args.runs)}
+
+        env["FIO_TEST_WORKER_SOCKET"] = sock
+        worker = subprocess.Popen(
+            [sys.executable, "-m", "fiotest.worker"],
+            env=env,
+            stderr=subprocess.DEVNULL,
+        )
+        while not os.path.exists(sock):
+            sleep(0.05)
+        results["worker"] = measure(env, workdir, args.runs)
+    finally:
+        if worker:
+            worker.terminate()
+        gateway.shutdown()
+        gateway.server_close()
+
+    for mode, samples in results.items():
+        startup = [s for s, _ in samples]
+        total = [t for _, t in samples]
+        print(
+            "%-7s %d runs: startup p50 %.3fs p95 %.3fs, total p50 %.3fs"
+            % (
+                mode,
+                len(samples),
+                _percentile(startup, 50),
+                _percentile(startup, 95),
+                _percentile(total, 50),
+            )
+        )
+
+
+if __name__ == "__main__":
+    main()
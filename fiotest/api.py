@@ -1,22 +1,72 @@
+from concurrent.futures import ThreadPoolExecutor
 import json
 import os
 import requests
 import sys
-from typing import Optional
+from time import time
+from typing import Callable, Dict, List, NamedTuple, Optional, Tuple, Union
 
-from fiotest.gateway_client import DeviceGatewayClient
+from fiotest import jsonstream, resumable, trace
+from fiotest.compression import CompressedReader, upload_encoding
+from fiotest.dedup import ArtifactIndex, digest, refs_result
+from fiotest.environment import (
+    dedup_artifacts,
+    fiotest_dir,
+    upload_chunk_bytes,
+    upload_compression,
+    upload_concurrency,
+)
+from fiotest.gateway_client import DeviceGatewayClient, Response
 
 
 def status(msg: str, prefix: str = "== "):
     """Print a commonly formatted status message to stdout.
        It also ensures the buffer is flushed and written immediately"""
-    sys.stdout.buffer.write(prefix.encode())
-    sys.stdout.buffer.write(b" ")
-    sys.stdout.buffer.write(msg.encode())
-    sys.stdout.buffer.write(b"\n")
+    # a single write keeps messages from concurrent uploads from interleaving
+    sys.stdout.buffer.write(prefix.encode() + b" " + msg.encode() + b"\n")
     sys.stdout.buffer.flush()
 
 
+def transient(status_code: int) -> bool:
+    """Return True if a request that got `status_code` may succeed later."""
+    return status_code in (0, 429) or status_code >= 500
+
+
+class GatewayError(SystemExit):
+    """The gateway refused a request. It is a SystemExit so a fio-test-wrap
+       that doesn't handle it exits with the message."""
+
+    def __init__(self, msg: str, status_code: int):
+        super().__init__(msg)
+        self.status_code = status_code
+
+    @property
+    def transient(self) -> bool:
+        return transient(self.status_code)
+
+
+class UploadResult(NamedTuple):
+    artifact: str
+    status_code: int  # 0 when the upload failed before getting a response
+    seconds: float
+    error: str = ""
+    bytes_raw: int = 0
+    bytes_sent: int = 0
+    urldata: Optional[dict] = None  # where it was uploaded, to retry it
+
+    @property
+    def ok(self) -> bool:
+        return self.status_code in (200, 201)
+
+    @property
+    def retriable(self) -> bool:
+        return not self.ok and transient(self.status_code)
+
+    @property
+    def bytes_saved(self) -> int:
+        return max(0, self.bytes_raw - self.bytes_sent)
+
+
 class API:
     def __init__(self, sota_dir: str, dryrun: bool):
         self.dryrun = dryrun
@@ -31,58 +81,265 @@ class API:
         )
         self.gateway = DeviceGatewayClient(sota_dir)
         self.sota_dir = sota_dir
+        self.uploads_dir = os.path.join(fiotest_dir(), "uploads")
+        resumable.prune(self.uploads_dir)
+        self.batching = True  # cleared if the gateway has no batch endpoint
+        self.dedup: Optional[ArtifactIndex] = None
+        if dedup_artifacts():
+            path = os.path.join(fiotest_dir(), "artifact-index.json")
+            self.dedup = ArtifactIndex(path)
 
     @property
     def headers(self):
-        cur_target = self.target_name(self.sota_dir)
-        return {"x-ats-target": cur_target}
+        return self._headers()
 
-    def start_test(self, name: str) -> str:
+    def _headers(self, target: Optional[str] = None):
+        if not target:
+            target = self.target_name(self.sota_dir)
+        return {"x-ats-target": target}
+
+    def start_test(self, name: str, target: Optional[str] = None) -> str:
         data = {"name": name}
         if not self.dryrun:
-            r = self.gateway.post(self.url, data, self.headers)
+            with trace.span("start_test", test=name):
+                r = self.gateway.post(self.url, data, self._headers(target))
             if r.status_code != 201:
-                sys.exit("Unable to start test: HTTP_%d: %s" % (r.status_code, r.text))
+                raise GatewayError(
+                    "Unable to start test: HTTP_%d: %s" % (r.status_code, r.text),
+                    r.status_code,
+                )
             return r.text.strip()
         return "DRYRUN"
 
-    def _upload_item(self, artifacts_dir, artifact, urldata):
+    def _upload_item(self, artifacts_dir, artifact, urldata) -> UploadResult:
         path = os.path.join(artifacts_dir, artifact)
         headers = {"Content-Type": urldata["content-type"]}
+        encoding = upload_encoding(path, upload_compression())
+        if encoding:
+            headers["Content-Encoding"] = encoding
 
+        status("Uploading " + artifact)
+        with trace.span("upload", artifact=artifact) as span:
+            res = self._upload_file(path, artifact, urldata, headers, encoding)
+            span.update(status=res.status_code, bytes_sent=res.bytes_sent)
+        return res._replace(urldata=urldata)
+
+    def _upload_file(self, path, artifact, urldata, headers, encoding) -> UploadResult:
+        start = time()
+        r: Union[Response, requests.Response]
         try:
+            size = os.path.getsize(path)
+            sent = size
             if urldata["url"].startswith(self.url):
-                r = self.gateway.put_file(urldata["url"], path, headers=headers)
+                ranged = None
+                chunk = upload_chunk_bytes()
+                # e.g. a console.log streamed while its test ran
+                progress = resumable.UploadProgress(self.uploads_dir, urldata["url"])
+                started = progress.load(size) is not None
+                if started or (chunk and size > chunk):
+                    # ranges are offsets into the file, so it's sent as-is
+                    plain = dict(headers)
+                    plain.pop("Content-Encoding", None)
+                    ranged = self.gateway.put_file_resumable(
+                        urldata["url"], path, plain, chunk or size, self.uploads_dir
+                    )
+                if ranged is not None:
+                    r = ranged
+                else:
+                    r = self.gateway.put_file(
+                        urldata["url"], path, headers=headers, encoding=encoding
+                    )
+                sent = r.bytes_sent
             else:
                 with open(path, "rb") as f:
-                    r = requests.put(urldata["url"], data=f, headers=headers,)
+                    if encoding:
+                        reader = CompressedReader(f, encoding)
+                        r = requests.put(urldata["url"], data=reader, headers=headers)
+                        sent = reader.sent_bytes
+                    else:
+                        r = requests.put(urldata["url"], data=f, headers=headers,)
 
             if r.status_code not in (200, 201):
                 status(
                     "Unable to upload %s to %s - HTTP_%d\n%s"
                     % (artifact, r.url, r.status_code, r.text)
                 )
+            return UploadResult(
+                artifact, r.status_code, time() - start, "", size, sent
+            )
         except Exception as e:
             status("Unexpected error for %s: %s" % (artifact, str(e)))
+            return UploadResult(artifact, 0, time() - start, str(e))
 
-    def complete_test(
-        self, test_id: str, data: dict, artifacts_dir: Optional[str] = None
+    def _upload_items(
+        self, artifacts_dir: Optional[str], urls: dict
+    ) -> List[UploadResult]:
+        """Upload artifacts using a bounded pool of workers. Results are
+           returned in the same order as `urls`."""
+        if not urls:
+            return []
+        workers = min(upload_concurrency(), len(urls))
+        with trace.span("upload_artifacts", count=len(urls)):
+            with ThreadPoolExecutor(max_workers=workers) as executor:
+                futures = [
+                    executor.submit(self._upload_item, artifacts_dir, name, urldata)
+                    for name, urldata in urls.items()
+                ]
+                results = [f.result() for f in futures]
+        for res in results:
+            msg = "Upload of %s: HTTP_%d in %.2fs" % (
+                res.artifact,
+                res.status_code,
+                res.seconds,
+            )
+            if res.bytes_saved:
+                # compressed, or resumed after an earlier attempt
+                msg += ", sent %d of %d bytes" % (res.bytes_sent, res.bytes_raw)
+            status(msg)
+        return results
+
+    def _list_artifacts(
+        self, artifacts_dir: Optional[str], data: dict, target: Optional[str]
+    ) -> Dict[str, str]:
+        """Set data["artifacts"] to the artifacts that need to be uploaded.
+           When deduplicating, artifacts already uploaded for the Target are
+           left out and listed in an "artifact-refs" result instead. Returns
+           the digests of the artifacts to upload."""
+        if not artifacts_dir:
+            return {}
+        artifacts = os.listdir(artifacts_dir)
+        digests: Dict[str, str] = {}
+        if self.dedup and artifacts and not self.dryrun:
+            target = target or self.target_name(self.sota_dir)
+            with trace.span("dedup", count=len(artifacts)):
+                for name in artifacts:
+                    path = os.path.join(artifacts_dir, name)
+                    if os.path.isfile(path):
+                        digests[name] = digest(path)
+                skipped = self.dedup.lookup(target, digests)
+            if skipped:
+                artifacts = [x for x in artifacts if x not in skipped]
+                for name in skipped:
+                    del digests[name]
+                # a new list, data may be shared with a retried delivery
+                refs = refs_result(skipped, time())
+                results = data.get("results", [])
+                data["results"] = jsonstream.Concat(results, [refs])
+                status(
+                    "Skipped %d unchanged artifacts: %d bytes and %d requests avoided"
+                    % (
+                        len(skipped),
+                        sum(x.size for x in skipped.values()),
+                        len(skipped),
+                    )
+                )
+        if artifacts:
+            data["artifacts"] = artifacts
+        return digests
+
+    def _remember_uploads(
+        self,
+        target: Optional[str],
+        test_id: str,
+        digests: Dict[str, str],
+        results: List[UploadResult],
     ):
-        if artifacts_dir:
-            artifacts = os.listdir(artifacts_dir)
-            if artifacts:
-                data["artifacts"] = artifacts
+        if self.dedup and digests:
+            uploaded = {r.artifact: digests[r.artifact] for r in results if r.ok}
+            sizes = {r.artifact: r.bytes_raw for r in results}
+            target = target or self.target_name(self.sota_dir)
+            self.dedup.add(target, test_id, uploaded, sizes)
+
+    def complete_test(
+        self,
+        test_id: str,
+        data: dict,
+        artifacts_dir: Optional[str] = None,
+        target: Optional[str] = None,
+    ) -> List[UploadResult]:
+        digests = self._list_artifacts(artifacts_dir, data, target)
         if self.dryrun:
-            print(json.dumps(data, indent=2))
-        else:
-            r = self.gateway.put(self.url + "/" + test_id, data, self.headers)
-            if r.status_code != 200:
-                sys.exit(
-                    "Unable to complete test: HTTP_%d: %s" % (r.status_code, r.text)
-                )
-            for artifact, urldata in json.loads(r.text).items():
-                status("Uploading " + artifact)
-                self._upload_item(artifacts_dir, artifact, urldata)
+            print(jsonstream.dumps(data, indent=2))
+            return []
+        with trace.span("complete_test", test_id=test_id):
+            url = self.url + "/" + test_id
+            r = self.gateway.put(url, data, self._headers(target))
+        if r.status_code != 200:
+            raise GatewayError(
+                "Unable to complete test: HTTP_%d: %s" % (r.status_code, r.text),
+                r.status_code,
+            )
+        results = self._upload_items(artifacts_dir, json.loads(r.text))
+        self._remember_uploads(target, test_id, digests, results)
+        return results
+
+    def upload_artifacts(
+        self,
+        test_id: str,
+        artifacts_dir: str,
+        urls: dict,
+        target: Optional[str] = None,
+    ) -> List[UploadResult]:
+        """Upload artifacts of a test that was already completed, e.g. the
+           ones that failed to upload when it was."""
+        digests: Dict[str, str] = {}
+        if self.dedup:
+            for name in urls:
+                path = os.path.join(artifacts_dir, name)
+                if os.path.isfile(path):
+                    digests[name] = digest(path)
+        results = self._upload_items(artifacts_dir, urls)
+        self._remember_uploads(target, test_id, digests, results)
+        return results
+
+    def complete_batch(
+        self,
+        tests: List[dict],
+        target: Optional[str] = None,
+        created_cb: Optional[Callable[[dict, str], None]] = None,
+    ) -> Optional[List[Tuple[str, List[UploadResult]]]]:
+        """Report several completed tests with a single request. Each item
+           in `tests` has the "name", "local_ts", "data" and "artifacts"
+           (directory or None) of a test. `created_cb` is called with each
+           test and its id before its artifacts are uploaded. Returns the id
+           and artifact upload results of each created test, or None if the
+           gateway doesn't support batches and the caller should fall back
+           to start_test/complete_test."""
+        if not self.batching:
+            return None
+        payload = []
+        digests = []
+        for test in tests:
+            item = dict(test["data"], name=test["name"], local_ts=test["local_ts"])
+            digests.append(self._list_artifacts(test["artifacts"], item, target))
+            payload.append(item)
+        if self.dryrun:
+            print(jsonstream.dumps(payload, indent=2))
+            return [("DRYRUN", [])] * len(tests)
+
+        url = self.url + "/batch"
+        with trace.span("complete_batch", tests=len(tests)):
+            data = {"tests": payload}
+            r = self.gateway.post(url, data, self._headers(target), False)
+        if r.status_code in (404, 405, 501):
+            status("Gateway does not support batched test results")
+            self.batching = False
+            return None
+        if r.status_code not in (200, 201):
+            raise GatewayError(
+                "Unable to complete tests: HTTP_%d: %s" % (r.status_code, r.text),
+                r.status_code,
+            )
+        completed = []
+        created_tests = json.loads(r.text)["tests"]
+        if created_cb:
+            for test, created in zip(tests, created_tests):
+                created_cb(test, created["id"])
+        for test, test_digests, created in zip(tests, digests, created_tests):
+            results = self._upload_items(test["artifacts"], created["artifacts"])
+            self._remember_uploads(target, created["id"], test_digests, results)
+            completed.append((created["id"], results))
+        return completed
 
     @staticmethod
     def target_name(sota_dir: str) -> str:
@@ -0,0 +1,72 @@
+"""A circuit breaker for the device gateway shared by every fiotest process.
+
+Each process reporting results used to find out the gateway was down on
+its own, by walking a full retry ladder. Here failures are counted in a
+small state file instead. Once `threshold` consecutive requests have
+failed the circuit opens and requests fail fast, which makes callers
+spool or defer their work. After a cooldown a single request is let
+through as a probe. If it succeeds the circuit closes again, if it fails
+the circuit stays open for twice as long.
+"""
+
+from time import time
+from typing import ContextManager
+
+from fiotest import statefile
+
+COOLDOWN = 30
+MAX_COOLDOWN = 600
+# how long other processes wait on a probe that never reports back
+PROBE_TIMEOUT = 120
+
+
+class CircuitBreaker:
+    def __init__(self, path: str, threshold: int = 5):
+        self.path = path
+        self.threshold = threshold
+
+    def _locked(self) -> ContextManager[dict]:
+        default = {"failures": 0, "opened": 0, "cooldown": 0, "probe": 0}
+        return statefile.locked(self.path, default)
+
+    def allow(self) -> bool:
+        """Return True if a request should be made now."""
+        if not self.threshold:
+            return True
+        now = time()
+        with self._locked() as state:
+            if not state["opened"]:
+                return True
+            if now < state["opened"] + state["cooldown"]:
+                return False
+            if now < state["probe"] + PROBE_TIMEOUT:
+                return False  # another process is probing
+            state["probe"] = now
+            return True
+
+    def is_open(self) -> bool:
+        if not self.threshold:
+            return False
+        with self._locked() as state:
+            return bool(state["opened"]) and (
+                time() < state["opened"] + state["cooldown"]
+                or time() < state["probe"] + PROBE_TIMEOUT
+            )
+
+    def success(self):
+        if not self.threshold:
+            return
+        with self._locked() as state:
+            state.update(failures=0, opened=0, cooldown=0, probe=0)
+
+    def failure(self):
+        if not self.threshold:
+            return
+        with self._locked() as state:
+            state["failures"] += 1
+            if state["probe"]:
+                # the probe failed, stay open for longer
+                cooldown = min(MAX_COOLDOWN, state["cooldown"] * 2)
+                state.update(opened=time(), cooldown=cooldown, probe=0)
+            elif not state["opened"] and state["failures"] >= self.threshold:
+                state.update(opened=time(), cooldown=COOLDOWN, probe=0)
@@ -1,5 +1,13 @@
-from http.server import HTTPServer, SimpleHTTPRequestHandler
-from typing import Optional
+import asyncio
+from bisect import bisect_left
+import json
+import logging
+from queue import Queue
+from threading import Thread
+from time import monotonic
+from typing import Dict, List, NamedTuple, Optional, Tuple
+
+log = logging.getLogger()
 
 
 class AktualizrCallbackHandler:
@@ -13,54 +21,161 @@ class AktualizrCallbackHandler:
         raise NotImplementedError()
 
 
-class AktualizrCallbacks(SimpleHTTPRequestHandler):
-    callback: AktualizrCallbackHandler = AktualizrCallbackHandler()
+class Histogram:
+    """A fixed bucket latency histogram. Bucket bounds are in seconds."""
 
-    def do_POST(self):
-        length = int(self.headers["content-length"])
-        buf = self.rfile.read(length)
-        parts = buf.decode().split(",")
+    bounds = (0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1.0, 5.0, 10.0, 60.0)
 
-        msg: str = ""
-        current: str = ""
-        status: Optional[str] = None
+    def __init__(self):
+        self.counts = [0] * (len(self.bounds) + 1)
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
 
-        try:
-            if len(parts) == 3:
-                msg, current, status = parts
-            elif len(parts) == 2:
-                msg, current = parts
-            else:
-                raise ValueError(buf)
-
-            if msg == "install-post":
-                assert status is not None  # for mypy
-                self.callback.on_install_post(current, status)
-            elif msg == "install-pre":
-                self.callback.on_install_pre(current)
-            elif msg == "check-for-update-pre":
-                self.callback.on_check_for_updates_pre(current)
-            else:
-                self.log_message("Ignoring callback msg: %s", msg)
+    def observe(self, seconds: float):
+        self.counts[bisect_left(self.bounds, seconds)] += 1
+        self.count += 1
+        self.total += seconds
+        self.max = max(self.max, seconds)
 
-        except Exception as e:
-            self.log_error("error: %r", e)
-            self.send_response(400)
-            self.send_header("Content-type", "text/plain")
-            self.end_headers()
-            self.wfile.write(str(e).encode())
-            return
+    def as_dict(self) -> dict:
+        buckets: Dict[str, int] = {}
+        for bound, count in zip(self.bounds + (float("inf"),), self.counts):
+            buckets["le_%g" % bound] = count
+        return {
+            "count": self.count,
+            "avg": self.total / self.count if self.count else 0.0,
+            "max": self.max,
+            "buckets": buckets,
+        }
+
+
+class CallbackEvent(NamedTuple):
+    msg: str
+    current_target: str
+    status: Optional[str]
 
-        self.send_response(201)
-        self.send_header("Content-type", "text/plain")
-        self.end_headers()
-        self.wfile.write(b"OK\n")
+
+def parse_callback(buf: bytes) -> CallbackEvent:
+    """Parse the "msg,current-target[,status]" body aklite-callback.sh sends."""
+    parts = buf.decode().split(",")
+    if len(parts) == 3:
+        return CallbackEvent(*parts)
+    elif len(parts) == 2:
+        return CallbackEvent(parts[0], parts[1], None)
+    raise ValueError(buf)
 
 
 class CallbackServer:
-    def __init__(self, handler: AktualizrCallbackHandler):
-        AktualizrCallbacks.callback = handler
-        self.httpd = HTTPServer(("", 8000), AktualizrCallbacks)
+    """An asyncio HTTP endpoint for aktualizr-lite callbacks. Callbacks are
+       acknowledged as soon as they are parsed and then handed, in order, to
+       a worker thread that runs the (possibly slow) handler. This keeps a
+       slow handler from blocking aktualizr-lite's install."""
+
+    max_request_bytes = 64 * 1024
+    read_timeout = 10
+
+    def __init__(self, handler: AktualizrCallbackHandler, port: int = 8000):
+        self.handler = handler
+        self.port = port
+        self.events: "Queue[CallbackEvent]" = Queue()
+        self.ack_latency = Histogram()
+        self.handler_latency = Histogram()
+        self._worker = Thread(target=self._process_events, daemon=True)
+
+    def _dispatch(self, event: CallbackEvent):
+        if event.msg == "install-post":
+            assert event.status is not None  # for mypy
+            self.handler.on_install_post(event.current_target, event.status)
+        elif event.msg == "install-pre":
+            self.handler.on_install_pre(event.current_target)
+        elif event.msg == "check-for-update-pre":
+            self.handler.on_check_for_updates_pre(event.current_target)
+        else:
+            log.info("Ignoring callback msg: %s", event.msg)
+
+    def _process_events(self):
+        while True:
+            event = self.events.get()
+            start = monotonic()
+            try:
+                self._dispatch(event)
+            except Exception:
+                log.exception("Error handling callback %s", event.msg)
+            elapsed = monotonic() - start
+            self.handler_latency.observe(elapsed)
+            log.debug("Callback %s handled in %.3fs", event.msg, elapsed)
+
+    def metrics(self) -> dict:
+        return {
+            "queued": self.events.qsize(),
+            "ack_latency": self.ack_latency.as_dict(),
+            "handler_latency": self.handler_latency.as_dict(),
+        }
+
+    async def _read_request(
+        self, reader: asyncio.StreamReader
+    ) -> Tuple[str, str, bytes]:
+        request = await reader.readline()
+        method, path, _ = request.decode().split(" ", 2)
+        length = 0
+        headers: List[bytes] = []
+        while True:
+            line = await reader.readline()
+            if line in (b"\r\n", b"\n", b""):
+                break
+            headers.append(line)
+            if len(headers) > 100:
+                raise ValueError("Too many headers")
+            key, val = line.decode().split(":", 1)
+            if key.strip().lower() == "content-length":
+                length = int(val)
+        if length > self.max_request_bytes:
+            raise ValueError("Request too large")
+        body = await reader.readexactly(length)
+        return method, path, body
+
+    @staticmethod
+    async def _respond(writer: asyncio.StreamWriter, status: str, body: bytes):
+        writer.write(
+            b"HTTP/1.1 %s\r\n"
+            b"Content-type: text/plain\r\n"
+            b"Content-Length: %d\r\n"
+            b"Connection: close\r\n\r\n" % (status.encode(), len(body))
+        )
+        writer.write(body)
+        await writer.drain()
+
+    async def _handle_client(
+        self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter
+    ):
+        start = monotonic()
+        try:
+            method, path, body = await asyncio.wait_for(
+                self._read_request(reader), self.read_timeout
+            )
+            if method == "GET" and path == "/metrics":
+                await self._respond(
+                    writer, "200 OK", json.dumps(self.metrics()).encode()
+                )
+                return
+            self.events.put(parse_callback(body))
+            await self._respond(writer, "201 Created", b"OK\n")
+            self.ack_latency.observe(monotonic() - start)
+        except Exception as e:
+            log.error("Callback error: %r", e)
+            try:
+                await self._respond(writer, "400 Bad Request", str(e).encode())
+            except ConnectionError:
+                pass
+        finally:
+            writer.close()
+
+    async def _serve(self):
+        server = await asyncio.start_server(self._handle_client, port=self.port)
+        async with server:
+            await server.serve_forever()
 
     def run_forever(self):
-        self.httpd.serve_forever()
+        self._worker.start()
+        asyncio.run(self._serve())
@@ -0,0 +1,91 @@
+"""On-the-fly compression of artifacts while they are being uploaded."""
+
+from typing import Any, BinaryIO, Iterator, Optional
+import zlib
+
+try:
+    import zstandard
+except ImportError:  # optional dependency
+    zstandard = None  # type: ignore
+
+# Artifacts with these extensions won't get any smaller
+COMPRESSED_EXTENSIONS = (
+    ".7z",
+    ".bz2",
+    ".gif",
+    ".gz",
+    ".jpeg",
+    ".jpg",
+    ".lz4",
+    ".mkv",
+    ".mp4",
+    ".png",
+    ".tgz",
+    ".webm",
+    ".webp",
+    ".xz",
+    ".zip",
+    ".zst",
+)
+
+CHUNK_SIZE = 64 * 1024
+
+
+def supported_encodings():
+    encodings = ["gzip"]
+    if zstandard:
+        encodings.append("zstd")
+    return encodings
+
+
+def upload_encoding(path: str, requested: str) -> Optional[str]:
+    """Return the Content-Encoding to upload `path` with or None if it should
+       be sent as-is."""
+    if requested not in supported_encodings():
+        return None
+    if path.lower().endswith(COMPRESSED_EXTENSIONS):
+        return None
+    return requested
+
+
+class CompressedReader:
+    """A file-like wrapper that compresses the underlying file as it is read.
+       It can be used as a pycurl READFUNCTION or iterated over to give
+       `requests` a chunked body. Nothing is written to disk."""
+
+    def __init__(self, f: BinaryIO, encoding: str):
+        self._compressor: Any
+        if encoding == "gzip":
+            self._compressor = zlib.compressobj(6, zlib.DEFLATED, 31)
+        elif encoding == "zstd" and zstandard:
+            self._compressor = zstandard.ZstdCompressor().compressobj()
+        else:
+            raise ValueError("Unsupported encoding: %s" % encoding)
+        self._f = f
+        self._buf = b""
+        self._eof = False
+        self.raw_bytes = 0
+        self.sent_bytes = 0
+
+    def _fill(self, size: int):
+        while len(self._buf) < size and not self._eof:
+            chunk = self._f.read(CHUNK_SIZE)
+            if chunk:
+                self.raw_bytes += len(chunk)
+                self._buf += self._compressor.compress(chunk)
+            else:
+                self._buf += self._compressor.flush()
+                self._eof = True
+
+    def read(self, size: int = CHUNK_SIZE) -> bytes:
+        self._fill(size)
+        data, self._buf = self._buf[:size], self._buf[size:]
+        self.sent_bytes += len(data)
+        return data
+
+    def __iter__(self) -> Iterator[bytes]:
+        while True:
+            data = self.read()
+            if not data:
+                return
+            yield data
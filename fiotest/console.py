@@ -0,0 +1,227 @@
+"""Capture of a test's console output."""
+
+import gzip
+import os
+import select
+from time import monotonic
+from typing import BinaryIO, List, Optional
+
+
+class TailBuffer:
+    """Keeps the last `max_bytes` of a stream so the end of a test's output
+       can be reported without holding all of it in memory."""
+
+    def __init__(self, max_bytes: int = 64 * 1024):
+        self.max_bytes = max_bytes
+        self._buf = bytearray()
+
+    def add(self, data: bytes):
+        self._buf += data
+        if len(self._buf) > 2 * self.max_bytes:
+            del self._buf[: -self.max_bytes]
+
+    def data(self) -> bytes:
+        return bytes(self._buf[-self.max_bytes :])
+
+    def lines(self, count: int) -> bytes:
+        """Return up to the last `count` lines kept in the buffer."""
+        buf = self.data()
+        end = len(buf)
+        if buf.endswith(b"\n"):
+            end -= 1
+        start = end
+        for _ in range(count):
+            start = buf.rfind(b"\n", 0, start)
+            if start == -1:
+                break
+        return buf[start + 1 :]
+
+
+class ConsoleCapture:
+    """Copies a test's output into console.log while mirroring it to stdout
+       with each line prefixed by "| ". Output is read in large chunks and
+       the mirror is written and flushed at most every `flush_interval`
+       seconds so a chatty test doesn't spend its time in this loop. With
+       `live` set, console.log is also flushed every `live` seconds while
+       there is new output, so the log can be read while the test runs."""
+
+    chunk_size = 64 * 1024
+
+    def __init__(
+        self,
+        console: BinaryIO,
+        mirror: BinaryIO,
+        prefix: bytes = b"| ",
+        flush_interval: float = 0.1,
+        live: float = 0,
+    ):
+        self.console = console
+        self.live = live
+        self.mirror = mirror
+        self.prefix = prefix
+        self.flush_interval = flush_interval
+        self.tail = TailBuffer()
+        self._pending: List[bytes] = []
+        self._line_start = True
+        self._last_flush = monotonic()
+        self._last_sync = monotonic()
+        self._unsynced = False
+
+    def feed(self, data: bytes):
+        self.console.write(data)
+        self.tail.add(data)
+        self._unsynced = bool(self.live)
+
+        out = data.replace(b"\n", b"\n" + self.prefix)
+        if self._line_start:
+            out = self.prefix + out
+        self._line_start = data.endswith(b"\n")
+        if self._line_start:
+            out = out[: -len(self.prefix)]
+        self._pending.append(out)
+
+    def flush(self):
+        if self._pending:
+            self.mirror.write(b"".join(self._pending))
+            self.mirror.flush()
+            self._pending = []
+        self._last_flush = monotonic()
+        if self._unsynced and self._last_flush - self._last_sync >= self.live:
+            self.console.flush()
+            self._unsynced = False
+            self._last_sync = self._last_flush
+
+    def run(self, fd: int):
+        """Capture everything from `fd` until EOF."""
+        try:
+            while True:
+                timeout: Optional[float] = None
+                if self._pending:
+                    due = self._last_flush + self.flush_interval
+                    timeout = max(0.0, due - monotonic())
+                if self._unsynced:
+                    wait = max(0.0, self._last_sync + self.live - monotonic())
+                    timeout = wait if timeout is None else min(timeout, wait)
+                ready, _, _ = select.select([fd], [], [], timeout)
+                if not ready:
+                    self.flush()  # output has gone quiet
+                    continue
+                data = os.read(fd, self.chunk_size)
+                if not data:
+                    break
+                self.feed(data)
+                if monotonic() - self._last_flush >= self.flush_interval:
+                    self.flush()
+        finally:
+            self.flush()
+
+
+class RotatingLog:
+    """A log file capped at roughly `max_bytes`. The first half of the cap
+       is kept in `path` itself. Everything after that is written to
+       gzip-compressed segments, path.1.gz, path.2.gz, ..., and only the
+       newest `segments` of them are kept. The head and tail of a huge log
+       survive while the middle is dropped."""
+
+    def __init__(self, path: str, max_bytes: int, segments: int = 4):
+        self.path = path
+        self.head_max = max_bytes // 2
+        self.segment_max = max(1, (max_bytes - self.head_max) // segments)
+        self.segments = segments
+        self._head = open(path, "wb")
+        self._head_size = 0
+        self._seg: Optional[gzip.GzipFile] = None
+        self._seg_idx = 0
+        self._seg_size = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def _segment_path(self, idx: int) -> str:
+        return "%s.%d.gz" % (self.path, idx)
+
+    def _rotate(self):
+        if self._seg:
+            self._seg.close()
+        self._seg_idx += 1
+        self._seg_size = 0
+        self._seg = gzip.open(self._segment_path(self._seg_idx), "wb")
+        old = self._seg_idx - self.segments
+        if old > 0:
+            os.unlink(self._segment_path(old))
+
+    def write(self, data: bytes):
+        if self._head_size < self.head_max:
+            head = data[: self.head_max - self._head_size]
+            self._head.write(head)
+            self._head_size += len(head)
+            data = data[len(head) :]
+        while data:
+            if not self._seg or self._seg_size >= self.segment_max:
+                self._rotate()
+            assert self._seg  # for mypy
+            part = data[: self.segment_max - self._seg_size]
+            self._seg.write(part)
+            self._seg_size += len(part)
+            data = data[len(part) :]
+
+    def flush(self):
+        self._head.flush()
+        if self._seg:
+            self._seg.flush()  # a sync point, the segment so far can be read
+
+    def close(self):
+        self._head.close()
+        if self._seg:
+            self._seg.close()
+
+
+def open_log(path: str, max_bytes: int):
+    """Open `path` for writing, capped at `max_bytes` when it is positive."""
+    if max_bytes > 0:
+        return RotatingLog(path, max_bytes)
+    return open(path, "wb")
+
+
+def segments(path: str) -> List[str]:
+    """Return the compressed segments RotatingLog wrote for `path`, oldest
+       first."""
+    dirname, base = os.path.split(path)
+    found = []
+    for name in os.listdir(dirname or "."):
+        idx = name[len(base) + 1 : -3]
+        if name.startswith(base + ".") and name.endswith(".gz") and idx.isdigit():
+            found.append((int(idx), os.path.join(dirname, name)))
+    return [p for _, p in sorted(found)]
+
+
+def read_excerpt(path: str, max_bytes: int = 64 * 1024) -> str:
+    """Return at most about `max_bytes` of a (possibly rotated) log: the
+       beginning and the end with a marker for anything left out."""
+    half = max_bytes // 2
+    size = os.path.getsize(path)
+    segs = segments(path)
+    if size <= max_bytes and not segs:
+        with open(path, "rb") as f:
+            return f.read().decode(errors="replace")
+
+    with open(path, "rb") as f:
+        head = f.read(half)
+        tail = TailBuffer(half)
+        # the newest segment may have only just been started
+        for seg in segs[-2:]:
+            with gzip.open(seg, "rb") as gz:
+                for chunk in iter(lambda: gz.read(ConsoleCapture.chunk_size), b""):
+                    tail.add(chunk)
+        if not segs:
+            f.seek(max(half, size - half))
+            tail.add(f.read())
+    data = tail.data()
+    data = data[data.find(b"\n") + 1 :]  # start on a line boundary
+    return "%s\n... [output truncated] ...\n%s" % (
+        head.decode(errors="replace"),
+        data.decode(errors="replace"),
+    )
@@ -0,0 +1,84 @@
+"""Skipping artifacts that were already uploaded for the current Target.
+
+Repeated sequences tend to produce the same artifacts over and over. Each
+artifact is hashed with BLAKE2 and looked up in a small index of what has
+been uploaded for the Target. A match is not uploaded again. The test's
+results say which earlier test holds the same content instead.
+"""
+
+import hashlib
+from typing import ContextManager, Dict, NamedTuple, Optional
+
+from fiotest import statefile
+
+CHUNK_SIZE = 1024 * 1024
+
+
+def digest(path: str) -> str:
+    h = hashlib.blake2b(digest_size=20)
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(CHUNK_SIZE), b""):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+class Uploaded(NamedTuple):
+    test_id: str
+    artifact: str
+    size: int
+
+
+class ArtifactIndex:
+    """Maps artifact digests to where they were first uploaded. Only the
+       current Target's artifacts are kept, and at most `max_entries` of
+       them. The index is shared by every process reporting results, so
+       updates are made under a lock."""
+
+    def __init__(self, path: str, max_entries: int = 2000):
+        self.path = path
+        self.max_entries = max_entries
+
+    def _locked(self) -> ContextManager[dict]:
+        return statefile.locked(self.path, {"target": None, "artifacts": {}})
+
+    def lookup(self, target: str, digests: Dict[str, str]) -> Dict[str, Uploaded]:
+        """Return the artifacts, keyed by name, of `digests` that have
+           already been uploaded for `target`."""
+        with self._locked() as index:
+            if index["target"] != target:
+                return {}
+            found = {}
+            for name, dig in digests.items():
+                entry = index["artifacts"].get(dig)
+                if entry:
+                    found[name] = Uploaded(*entry)
+            return found
+
+    def add(self, target: str, test_id: str, digests: Dict[str, str], sizes=None):
+        with self._locked() as index:
+            if index["target"] != target:
+                index.update(target=target, artifacts={})
+            artifacts = index["artifacts"]
+            for name, dig in digests.items():
+                size = sizes.get(name, 0) if sizes else 0
+                artifacts.setdefault(dig, [test_id, name, size])
+            while len(artifacts) > self.max_entries:
+                del artifacts[next(iter(artifacts))]  # the oldest entry
+
+
+def refs_result(skipped: Dict[str, Uploaded], local_ts: Optional[float]) -> dict:
+    """A result listing the artifacts that were not uploaded again."""
+    lines = [
+        "%s: same as %s of test %s" % (name, up.artifact, up.test_id)
+        for name, up in sorted(skipped.items())
+    ]
+    return {
+        "name": "artifact-refs",
+        "status": "PASSED",
+        "local_ts": local_ts,
+        "details": "\n".join(lines),
+        "metrics": {
+            "artifacts_skipped": len(skipped),
+            "bytes_skipped": sum(up.size for up in skipped.values()),
+        },
+    }
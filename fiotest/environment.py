@@ -1,5 +1,6 @@
 """Fiotest environment module."""
 
+import json
 import os
 
 
@@ -13,6 +14,43 @@ def _get_bools(env_var: str, default: bool) -> bool:
     return os.environ.get(env_var).lower() in _TRUES
 
 
+def fiotest_dir() -> str:
+    """Get the directory fiotest keeps its persistent state in."""
+    return os.environ.get("FIO_TEST_DIR", "/var/lib/fiotest")
+
+
+def spool_mode() -> bool:
+    """Check if results should be spooled to disk instead of sent directly."""
+    return _get_bools("FIO_TEST_SPOOL", False)
+
+
+def attach_series() -> bool:
+    """Check if raw time-series metrics should be uploaded as artifacts."""
+    return _get_bools("FIO_TEST_ATTACH_SERIES", False)
+
+
+def log_max_bytes() -> int:
+    """Get the size test logs are capped at. 0 means unlimited."""
+    return int(os.environ.get("FIO_TEST_LOG_MAX_BYTES", str(64 * 1024 * 1024)))
+
+
+def dedup_artifacts() -> bool:
+    """Check if artifacts already uploaded for the Target should be skipped."""
+    return _get_bools("FIO_TEST_DEDUP_ARTIFACTS", False)
+
+
+def trace_results() -> bool:
+    """Check if a trace of where a test's time went should be attached to
+       its results."""
+    return _get_bools("FIO_TEST_TRACE", False)
+
+
+def worker_socket() -> str:
+    """Get the Unix socket of the resident fio-test-wrap worker. An empty
+       value disables the worker."""
+    return os.environ.get("FIO_TEST_WORKER_SOCKET", "/tmp/fiotest-wrap.sock")
+
+
 def docker_host() -> str:
     """Get the docker host IP address."""
     return os.environ.get("FIO_TEST_DOCKER_HOST", "172.17.0.1")
@@ -26,3 +64,58 @@ def debug_mode() -> bool:
 def dry_run() -> bool:
     """Check if dry run mode is enabled."""
     return _get_bools("FIO_TEST_DRYRUN", os.environ.get("DRYRUN"))
+
+
+def upload_concurrency() -> int:
+    """Get the maximum number of artifacts to upload in parallel."""
+    return max(1, int(os.environ.get("FIO_TEST_UPLOAD_CONCURRENCY", "4")))
+
+
+def upload_compression() -> str:
+    """Get the encoding (gzip or zstd) used to compress uploaded artifacts."""
+    return os.environ.get("FIO_TEST_UPLOAD_COMPRESSION", "").lower()
+
+
+def upload_chunk_bytes() -> int:
+    """Get the size of the ranges large artifacts are uploaded in."""
+    return int(os.environ.get("FIO_TEST_UPLOAD_CHUNK_BYTES", str(8 * 1024 * 1024)))
+
+
+def breaker_threshold() -> int:
+    """Get how many gateway failures in a row make fiotest stop trying."""
+    return int(os.environ.get("FIO_TEST_BREAKER_THRESHOLD", "5"))
+
+
+def kickoff_spread() -> int:
+    """Get the window, in seconds, a fleet's test kickoffs are spread over."""
+    return int(os.environ.get("FIO_TEST_KICKOFF_SPREAD", "0"))
+
+
+def gateway_rate() -> float:
+    """Get the maximum rate of gateway requests per second."""
+    return float(os.environ.get("FIO_TEST_GATEWAY_RATE", "0"))
+
+
+def upload_rate() -> float:
+    """Get the maximum rate of artifact uploads in bytes per second."""
+    return float(os.environ.get("FIO_TEST_UPLOAD_RATE", "0"))
+
+
+def test_limits() -> dict:
+    """Get the resource limits the runner gave fio-test-wrap's test."""
+    return json.loads(os.environ.get("FIO_TEST_LIMITS") or "{}")
+
+
+def test_on_host() -> bool:
+    """Get whether fio-test-wrap's test runs on the host over ssh."""
+    return _get_bools("FIO_TEST_ON_HOST", False)
+
+
+def test_checkpoint() -> str:
+    """Get the file the runner keeps fio-test-wrap's progress on a test in."""
+    return os.environ.get("FIO_TEST_CHECKPOINT", "")
+
+
+def log_stream_seconds() -> float:
+    """Get how often a running test's console.log is sent to the gateway."""
+    return float(os.environ.get("FIO_TEST_LOG_STREAM_SECONDS", "0"))
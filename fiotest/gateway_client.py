@@ -1,17 +1,39 @@
 #!/usr/bin/python3
 
 import ctypes
+from contextlib import contextmanager
 from io import BytesIO
-import json
 import os
 import logging
 import subprocess
-from time import sleep
-from typing import Dict, NamedTuple, Optional
+from threading import Lock
+from email.utils import parsedate_to_datetime
+from random import uniform
+from time import sleep, time
+from typing import Callable, Dict, Iterator, List, NamedTuple, Optional, Tuple
 
 import pycurl
 
+from fiotest import trace
+from fiotest.breaker import CircuitBreaker
+from fiotest.compression import CompressedReader
+from fiotest.environment import (
+    breaker_threshold,
+    fiotest_dir,
+    gateway_rate,
+    upload_rate,
+)
+from fiotest.jsonstream import JSONReader
+from fiotest.pacing import Pacer
+from fiotest.resumable import RangeSupport, UploadProgress, committed
+
 log = logging.getLogger()
+RETRIES = 6
+# backoff between retries is jittered between these, in seconds
+BACKOFF_BASE = 1.0
+BACKOFF_CAP = 16.0
+MAX_RETRY_AFTER = 60.0
+TRANSIENT = (0, 429, 500, 502, 503, 504)  # 0 is a failed connection
 module = b"/usr/lib/softhsm/libsofthsm2.so"
 
 
@@ -59,13 +81,58 @@ class Response(NamedTuple):
     url: str
     status_code: int
     text: str
+    bytes_sent: int = 0
+    retry_after: Optional[float] = None  # seconds, when the server asked
+
+
+class _ResponseHeaders(dict):
+    """A HEADERFUNCTION collecting response headers by lower case name."""
+
+    def __call__(self, line: bytes):
+        if b":" in line:
+            key, val = line.decode("latin1").split(":", 1)
+            self[key.strip().lower()] = val.strip()
+
+    def retry_after(self) -> Optional[float]:
+        val = self.get("retry-after")
+        if not val:
+            return None
+        if val.isdigit():
+            return float(val)
+        try:
+            return max(0.0, parsedate_to_datetime(val).timestamp() - time())
+        except (TypeError, ValueError):
+            return None
 
 
 class DeviceGatewayClient:
     _initialized = None
+    _share: Optional[pycurl.CurlShare] = None
 
     def __init__(self, sota_dir: str):
         self.verbose = False
+        # Curl handles are kept around after each request so that their
+        # connection cache (and the TLS session behind it) can be reused by
+        # the next request. This matters on HSM backed devices where every
+        # handshake is a slow private key operation.
+        self._pool: List[pycurl.Curl] = []
+        self._pool_lock = Lock()
+        self.handshakes = 0
+        self.requests = 0
+        self.resumed_bytes = 0  # not sent again thanks to ranged uploads
+        # shared with every other process talking to the gateway
+        health = os.path.join(fiotest_dir(), "gateway-health.json")
+        self.breaker = CircuitBreaker(health, breaker_threshold())
+        pacing = os.path.join(fiotest_dir(), "gateway-pacing.json")
+        self.pacer = Pacer(pacing, gateway_rate(), upload_rate())
+        if DeviceGatewayClient._share is None:
+            share = pycurl.CurlShare()
+            share.setopt(pycurl.SH_SHARE, pycurl.LOCK_DATA_DNS)
+            share.setopt(pycurl.SH_SHARE, pycurl.LOCK_DATA_SSL_SESSION)
+            if hasattr(pycurl, "LOCK_DATA_CONNECT"):
+                # libcurl >= 7.57 can share the connection cache itself
+                share.setopt(pycurl.SH_SHARE, pycurl.LOCK_DATA_CONNECT)
+            DeviceGatewayClient._share = share
         self._root_crt = os.path.join(sota_dir, "root.crt")
         with open(os.path.join(sota_dir, "sota.toml")) as f:
             source = module = pin = pk = cert = None
@@ -99,17 +166,19 @@ class DeviceGatewayClient:
                 pkey = os.path.join(sota_dir, "pkey.pem")
                 DeviceGatewayClient._initialized = ("PEM", cert, pkey)
 
-    def _curl_init(self, url: str) -> pycurl.Curl:
-        c = pycurl.Curl()
+    def _curl_init(self, c: pycurl.Curl, url: str) -> pycurl.Curl:
+        c.setopt(pycurl.TCP_KEEPALIVE, 1)
         c.setopt(pycurl.SSL_VERIFYPEER, 1)
         c.setopt(pycurl.SSL_VERIFYHOST, 2)
         c.setopt(pycurl.USE_SSL, pycurl.USESSL_ALL)
-        c.setopt(pycurl.SSLENGINE, "pkcs11")
-        c.setopt(pycurl.SSLENGINE_DEFAULT, 1)
+
+        assert DeviceGatewayClient._initialized is not None  # for mypy
+        if DeviceGatewayClient._initialized[0] == "ENG":
+            c.setopt(pycurl.SSLENGINE, "pkcs11")
+            c.setopt(pycurl.SSLENGINE_DEFAULT, 1)
 
         c.setopt(pycurl.CAINFO, self._root_crt)
 
-        assert DeviceGatewayClient._initialized is not None  # for mypy
         c.setopt(pycurl.SSLCERT, DeviceGatewayClient._initialized[1])
         c.setopt(pycurl.SSLCERTTYPE, DeviceGatewayClient._initialized[0])
 
@@ -122,62 +191,308 @@ class DeviceGatewayClient:
             c.setopt(pycurl.VERBOSE, 1)
         return c
 
-    def _op(self, op: int, url: str, data: dict, headers: Dict[str, str]) -> Response:
+    @contextmanager
+    def _curl(self, url: str) -> Iterator[pycurl.Curl]:
+        """Check out a curl handle from the pool configured for `url`.
+           The handle is returned to the pool afterwards so its connection
+           can be kept alive for the next request."""
+        with self._pool_lock:
+            c = self._pool.pop() if self._pool else None
+        if c is None:
+            c = pycurl.Curl()
+            c.setopt(pycurl.SHARE, DeviceGatewayClient._share)
+        else:
+            # clears options but keeps the connection cache and share
+            c.reset()
+        try:
+            yield self._curl_init(c, url)
+        except Exception:
+            c.close()
+            raise
+        connects = c.getinfo(pycurl.NUM_CONNECTS)
+        with self._pool_lock:
+            # the counters are updated by concurrent uploads too
+            self.requests += 1
+            self.handshakes += connects
+            self._pool.append(c)
+
+    def close(self):
+        with self._pool_lock:
+            for c in self._pool:
+                c.close()
+            self._pool = []
+
+    def _perform(
+        self,
+        url: str,
+        span_args: dict,
+        setup: Callable[[pycurl.Curl], None],
+        upload_bytes: int = 0,
+    ) -> Tuple[Response, _ResponseHeaders]:
+        """Make a request with a pooled handle prepared by `setup`. A failed
+           connection is returned as a response with a status of 0 so it's
+           retried like an error from the server."""
+        self.pacer.wait(upload_bytes)
         buf = BytesIO()
+        resp_headers = _ResponseHeaders()
+        with trace.span("http", **span_args) as span:
+            try:
+                with self._curl(url) as c:
+                    setup(c)
+                    c.setopt(pycurl.WRITEDATA, buf)
+                    c.setopt(pycurl.HEADERFUNCTION, resp_headers)
+                    c.perform()
+                    status = c.getinfo(pycurl.RESPONSE_CODE)
+            except pycurl.error as e:
+                status = 0
+                buf.write(str(e).encode())
+            span["status"] = status
+        r = Response(url, status, buf.getvalue().decode("utf-8", "replace"))
+        r = r._replace(retry_after=resp_headers.retry_after())
+        if r.retry_after and status in TRANSIENT:
+            # the gateway is pacing the device, not just this request
+            self.pacer.hold(min(r.retry_after, MAX_RETRY_AFTER))
+        return r, resp_headers
+
+    def _op(self, op: int, url: str, data: dict, headers: Dict[str, str]) -> Response:
         headers["Content-type"] = "application/json"
+        # the body is encoded while it is sent so its size isn't known
+        headers["Transfer-Encoding"] = "chunked"
+        headers["Expect"] = ""  # don't wait for a "100 Continue"
         header_array = [k + ": " + v for k, v in headers.items()]
-        c = self._curl_init(url)
-        try:
+        method = "PUT" if op == pycurl.PUT else "POST"
+
+        def setup(c: pycurl.Curl):
             if op in (pycurl.PUT, pycurl.POST):
                 if op == pycurl.PUT:
-                    c.setopt(pycurl.CUSTOMREQUEST, "PUT")
-                c.setopt(pycurl.POSTFIELDS, json.dumps(data))
+                    c.setopt(pycurl.UPLOAD, 1)
+                else:
+                    c.setopt(pycurl.POST, 1)
+                c.setopt(pycurl.READFUNCTION, JSONReader(data).read)
             c.setopt(pycurl.HTTPHEADER, header_array)
-            c.setopt(pycurl.WRITEDATA, buf)
-            c.perform()
-            status = c.getinfo(pycurl.RESPONSE_CODE)
-            return Response(url, status, buf.getvalue().decode())
-        finally:
-            c.close()
 
-    def _retriable_op(
-        self, op: int, url: str, data: dict, headers: Dict[str, str]
+        return self._perform(url, {"method": method, "url": url}, setup)[0]
+
+    @staticmethod
+    def _backoff(attempt: int, seconds: float):
+        if seconds:
+            with trace.span("retry_sleep", attempt=attempt, seconds=seconds):
+                sleep(seconds)
+
+    @staticmethod
+    def _next_delay(delay: float, r: Response) -> float:
+        """Decorrelated jitter: each delay is picked at random between the
+           base and three times the previous one, so processes retrying at
+           the same time spread out. A Retry-After is always waited out."""
+        delay = min(BACKOFF_CAP, uniform(BACKOFF_BASE, max(BACKOFF_BASE, delay * 3)))
+        if r.retry_after is not None:
+            delay = max(delay, min(r.retry_after, MAX_RETRY_AFTER))
+        return delay
+
+    def _record(self, r: Response):
+        """Let the circuit breaker know how the gateway is doing."""
+        if r.status_code in TRANSIENT:
+            self.breaker.failure()
+        else:
+            self.breaker.success()
+
+    def _unavailable(self, url: str) -> Response:
+        log.error("Gateway unavailable, not sending request: %s", url)
+        return Response(url, 0, "Gateway unavailable (circuit breaker open)")
+
+    def _retry(
+        self, url: str, request: Callable[[int], Response], attempts: int = RETRIES
     ) -> Response:
-        for i in (0, 1, 2, 4, 8, 16):
-            sleep(i)
-            r = self._op(op, url, data, headers)
+        """Call `request(attempt)` until it succeeds or fails for good. Only
+           failures that can be transient are retried. Nothing is sent while
+           the gateway's circuit breaker is open."""
+        delay = 0.0
+        attempt = 0
+        while True:
+            if not self.breaker.allow():
+                return self._unavailable(url)
+            r = request(attempt)
+            self._record(r)
             if r.status_code in (200, 201):
-                break
-            else:
-                log.error("HTTP_%d: %s: %s", r.status_code, r.url, r.text)
-        return r
+                return r
+            log.error("HTTP_%d: %s: %s", r.status_code, r.url, r.text)
+            attempt += 1
+            if attempt == attempts or r.status_code not in TRANSIENT:
+                return r
+            delay = self._next_delay(delay, r)
+            self._backoff(attempt, delay)
 
-    def post(self, url: str, data: dict, headers: Dict[str, str]) -> Response:
-        return self._retriable_op(pycurl.POST, url, data, headers)
+    def _retriable_op(
+        self, op: int, url: str, data: dict, headers: Dict[str, str], attempts=RETRIES
+    ) -> Response:
+        return self._retry(
+            url, lambda attempt: self._op(op, url, data, headers), attempts
+        )
+
+    def post(
+        self, url: str, data: dict, headers: Dict[str, str], retry: bool = True
+    ) -> Response:
+        attempts = RETRIES if retry else 1
+        return self._retriable_op(pycurl.POST, url, data, headers, attempts)
 
     def put(self, url: str, data: dict, headers: Dict[str, str]) -> Response:
         return self._retriable_op(pycurl.PUT, url, data, headers)
 
-    def put_file(self, url: str, path: str, headers: Dict[str, str]) -> Response:
-        for i in (0, 1, 2, 4, 8, 16):
-            sleep(i)
-            buf = BytesIO()
-            header_array = [k + ": " + v for k, v in headers.items()]
-            c = self._curl_init(url)
-            try:
-                c.setopt(pycurl.CUSTOMREQUEST, "PUT")
-                c.setopt(pycurl.HTTPHEADER, header_array)
-                c.setopt(pycurl.WRITEDATA, buf)
-                c.setopt(pycurl.UPLOAD, 1)
-                with open(path) as f:
-                    c.setopt(pycurl.READDATA, f)
-                    c.perform()
-                status = c.getinfo(pycurl.RESPONSE_CODE)
-                r = Response(url, status, buf.getvalue().decode())
-                if r.status_code in (200, 201):
-                    break
-                else:
-                    log.error("HTTP_%d: %s: %s", r.status_code, r.url, r.text)
-            finally:
-                c.close()
-        return r
+    def put_file(
+        self,
+        url: str,
+        path: str,
+        headers: Dict[str, str],
+        encoding: Optional[str] = None,
+    ) -> Response:
+        """Upload the file at `path`. If `encoding` is given the file is
+           compressed with it as it is streamed out."""
+        header_array = [k + ": " + v for k, v in headers.items()]
+
+        def request(attempt: int) -> Response:
+            with open(path, "rb") as f:
+                reader = CompressedReader(f, encoding) if encoding else None
+
+                def setup(c: pycurl.Curl):
+                    c.setopt(pycurl.CUSTOMREQUEST, "PUT")
+                    c.setopt(pycurl.HTTPHEADER, header_array)
+                    c.setopt(pycurl.UPLOAD, 1)
+                    if reader:
+                        c.setopt(pycurl.READFUNCTION, reader.read)
+                    else:
+                        c.setopt(pycurl.READDATA, f)
+
+                span_args = {"method": "PUT", "url": url, "attempt": attempt}
+                size = os.fstat(f.fileno()).st_size
+                r = self._perform(url, span_args, setup, size)[0]
+                # SIZE_UPLOAD would include the chunked encoding overhead
+                sent = reader.sent_bytes if reader else f.tell()
+            return r._replace(bytes_sent=sent)
+
+        return self._retry(url, request)
+
+    def _put_range(
+        self,
+        url: str,
+        headers: Dict[str, str],
+        size: Optional[int],
+        f=None,
+        start: int = 0,
+        end: int = 0,
+    ) -> Tuple[Response, Optional[str]]:
+        """PUT bytes [start, end) of the file `f`, out of `size` or an as
+           yet unknown number of bytes when None. Without a file this asks
+           how much of the upload the server has. Returns the response and
+           its Range header."""
+        total = "*" if size is None else str(size)
+        if f is None:
+            content_range = "bytes */" + total
+        else:
+            content_range = "bytes %d-%d/%s" % (start, end - 1, total)
+            f.seek(start)
+        left = end - start
+
+        def read(n: int) -> bytes:
+            nonlocal left
+            data = f.read(min(n, left)) if f else b""
+            left -= len(data)
+            return data
+
+        header_array = [k + ": " + v for k, v in headers.items()]
+        header_array += ["Content-Range: " + content_range, "Expect:"]
+
+        def setup(c: pycurl.Curl):
+            c.setopt(pycurl.UPLOAD, 1)
+            c.setopt(pycurl.INFILESIZE, end - start)
+            c.setopt(pycurl.READFUNCTION, read)
+            c.setopt(pycurl.HTTPHEADER, header_array)
+
+        span_args = {"method": "PUT", "url": url, "range": content_range}
+        r, resp_headers = self._perform(url, span_args, setup, end - start)
+        self._record(r)
+        return r._replace(bytes_sent=end - start - left), resp_headers.get("range")
+
+    def append_range(
+        self, url: str, f, headers: Dict[str, str], start: int, end: int
+    ) -> Tuple[Response, int]:
+        """Send bytes [start, end) of a file that is still growing, like a
+           running test's console.log, as a range of an upload whose size
+           isn't known yet. Returns the response and how many bytes the
+           server now has. It isn't retried, the caller sends the same range
+           again later."""
+        if not self.breaker.allow():
+            return self._unavailable(url), start
+        r, committed_range = self._put_range(url, headers, None, f, start, end)
+        if r.status_code == 308:
+            return r, committed(committed_range)
+        return r, start
+
+    def put_file_resumable(
+        self,
+        url: str,
+        path: str,
+        headers: Dict[str, str],
+        chunk_size: int,
+        state_dir: str,
+    ) -> Optional[Response]:
+        """Upload the file at `path` in ranges of `chunk_size` bytes. After a
+           failure, or when an earlier attempt left progress in `state_dir`,
+           the server is asked how much it has and the upload continues from
+           there. Returns None if the server doesn't take ranged uploads and
+           the file should be sent with put_file instead."""
+        servers = RangeSupport(state_dir)
+        supported = servers.get(url)
+        if supported is False:
+            return None
+        progress = UploadProgress(state_dir, url)
+        size = os.path.getsize(path)
+        query = not supported or progress.load(size) is not None
+        offset = sent = failures = 0
+        delay = 0.0
+        with open(path, "rb") as f:
+            while True:
+                if not self.breaker.allow():
+                    # the progress is kept for the next attempt
+                    return self._unavailable(url)._replace(bytes_sent=sent)
+                if query:
+                    r, committed_range = self._put_range(url, headers, size)
+                    if r.status_code == 308:
+                        if not supported:
+                            servers.set(url, True)
+                            supported = True
+                        offset = committed(committed_range)
+                        if offset:
+                            log.info("Resuming %s at %d/%d bytes", path, offset, size)
+                            with self._pool_lock:
+                                self.resumed_bytes += offset
+                        query = False
+                    elif not supported and r.status_code not in TRANSIENT:
+                        # an empty PUT a plain server may have just stored,
+                        # put_file will overwrite it
+                        servers.set(url, False)
+                        return None
+                    elif r.status_code in (200, 201):
+                        progress.remove()
+                        return r._replace(bytes_sent=sent)
+                if not query:
+                    end = min(size, offset + chunk_size)
+                    r, committed_range = self._put_range(
+                        url, headers, size, f, offset, end
+                    )
+                    sent += r.bytes_sent
+                    if r.status_code in (200, 201):
+                        progress.remove()
+                        return r._replace(bytes_sent=sent)
+                    if r.status_code == 308:
+                        offset = committed(committed_range)
+                        progress.save(size, offset)
+                        failures = 0
+                        delay = 0.0
+                        continue
+                log.error("HTTP_%d: %s: %s", r.status_code, r.url, r.text)
+                failures += 1
+                if failures == RETRIES or r.status_code not in TRANSIENT:
+                    return r._replace(bytes_sent=sent)
+                delay = self._next_delay(delay, r)
+                self._backoff(failures, delay)
+                query = True
@@ -1,14 +1,23 @@
 import asyncio
 import asyncssh
+import logging
 import sys
+from threading import Lock, Thread
+from time import monotonic
 from typing import Optional
 
 from fiotest.environment import docker_host
 
+log = logging.getLogger()
+
 
 def _host_connect():
     return asyncssh.connect(
-        docker_host(), known_hosts=None, username="fio", password="fio"
+        docker_host(),
+        known_hosts=None,
+        username="fio",
+        password="fio",
+        keepalive_interval=30,
     )
 
 
@@ -22,28 +31,93 @@ class MySSHClientSession(asyncssh.SSHClientSession):
             raise
 
 
+class HostConnection:
+    """A long-lived SSH connection to the host. Each command gets its own
+       channel on the connection so key exchange and authentication only
+       happen once. The connection is re-established if it drops."""
+
+    def __init__(self):
+        self._loop = asyncio.new_event_loop()
+        self._thread = Thread(target=self._loop.run_forever, daemon=True)
+        self._thread.start()
+        self._conn: Optional[asyncssh.SSHClientConnection] = None
+        self.connects = 0
+        self.channels = 0
+        self.channel_open_seconds = 0.0
+
+    async def _connection(self) -> asyncssh.SSHClientConnection:
+        if self._conn is None:
+            self._conn = await _host_connect()
+            self.connects += 1
+        return self._conn
+
+    async def _open_channel(self, cmd: str):
+        for attempt in (0, 1):
+            conn = await self._connection()
+            start = monotonic()
+            try:
+                chan, _ = await conn.create_session(MySSHClientSession, cmd)
+            except (OSError, asyncssh.Error):
+                # The connection may have died since it was last used
+                conn.close()
+                self._conn = None
+                if attempt:
+                    raise
+                continue
+            elapsed = monotonic() - start
+            self.channels += 1
+            self.channel_open_seconds += elapsed
+            log.debug("Host channel opened in %.3fs", elapsed)
+            return chan
+
+    async def _execute(self, cmd: str, stdin: Optional[str]) -> int:
+        chan = await self._open_channel(cmd)
+        if stdin:
+            chan.write(stdin + "\n")
+            chan.write_eof()
+        await chan.wait_closed()
+        return chan.get_exit_status()
+
+    def execute(self, cmd: str, stdin: Optional[str] = None) -> int:
+        fut = asyncio.run_coroutine_threadsafe(self._execute(cmd, stdin), self._loop)
+        try:
+            return fut.result()
+        except (OSError, asyncssh.Error) as exc:
+            print("SSH connection failed: " + str(exc))
+            return 1
+
+    def stats(self) -> dict:
+        avg = 0.0
+        if self.channels:
+            avg = self.channel_open_seconds / self.channels
+        return {
+            "connects": self.connects,
+            "channels": self.channels,
+            "reused": max(0, self.channels - self.connects),
+            "channel_open_avg_seconds": avg,
+        }
+
+
+_connection: Optional[HostConnection] = None
+_connection_lock = Lock()
+
+
+def host_connection() -> HostConnection:
+    global _connection
+    with _connection_lock:
+        if _connection is None:
+            _connection = HostConnection()
+        return _connection
+
+
+def stats() -> Optional[dict]:
+    """Return the stats of the host connection, if one was made."""
+    with _connection_lock:
+        return _connection.stats() if _connection else None
+
+
 def execute(cmd: str, stdin: Optional[str] = None) -> int:
-    try:
-        loop = asyncio.get_event_loop()
-    except RuntimeError:
-        # we are doing async on a thread that hasn't been set up
-        loop = asyncio.new_event_loop()
-        asyncio.set_event_loop(loop)
-
-    async def ssh():
-        async with _host_connect() as conn:
-            chan, session = await conn.create_session(MySSHClientSession, cmd)
-            if stdin:
-                chan.write(stdin + "\n")
-                chan.write_eof()
-            await chan.wait_closed()
-            return chan.get_exit_status()
-
-    try:
-        return loop.run_until_complete(ssh())
-    except (OSError, asyncssh.Error) as exc:
-        print("SSH connection failed: " + str(exc))
-        return 1
+    return host_connection().execute(cmd, stdin)
 
 
 def sudo_execute(cmd: str) -> int:
@@ -0,0 +1,111 @@
+"""Progress of the runner through a test spec, kept across restarts.
+
+The runner used to remember only which sequence a reboot returned to. A
+container restart, an OOM kill or an install that was started and
+abandoned made it run the current sequence again from its first test, and
+report every result a second time. The journal records each test as it
+completes, per loop of a repeated sequence, so the runner can pick up
+exactly where it stopped. It belongs to one Target and one version of the
+spec and starts over when either changes.
+
+A test that is interrupted after it has been started on the device gateway
+leaves a checkpoint behind with its test id. fio-test-wrap reuses that id
+when the test is run again, and marks the checkpoint once the results have
+been handed off, so a runner that dies before recording the test doesn't
+report it twice.
+"""
+
+from contextlib import contextmanager
+import hashlib
+import os
+from shutil import rmtree
+from typing import Iterator, Tuple
+
+from fiotest import statefile
+
+
+def read_checkpoint(path: str) -> dict:
+    return statefile.read(path, {})
+
+
+def write_checkpoint(path: str, **fields):
+    """Add `fields` to the checkpoint at `path`."""
+    state = read_checkpoint(path)
+    state.update(fields)
+    statefile.write(path, state)
+
+
+class RunJournal:
+    def __init__(self, path: str, target: str, spec: str):
+        self.path = path
+        self.checkpoints = path + ".d"
+        self.key = {
+            "target": target,
+            "spec": hashlib.blake2b(spec.encode(), digest_size=16).hexdigest(),
+        }
+
+    def _fresh(self) -> dict:
+        rmtree(self.checkpoints, ignore_errors=True)
+        return dict(self.key, seq_idx=0, seqs={})
+
+    @contextmanager
+    def _locked(self) -> Iterator[dict]:
+        with statefile.locked(self.path, {}) as state:
+            if any(state.get(k) != v for k, v in self.key.items()):
+                state.clear()
+                state.update(self._fresh())
+            yield state
+
+    def unfinished(self, sequences: int) -> bool:
+        """Return True if a run of the spec was interrupted part way."""
+        with self._locked() as state:
+            return state.get("started", False) and state["seq_idx"] < sequences
+
+    def begin(self, sequences: int) -> int:
+        """Start or resume a run and return the sequence to continue from.
+           A run that went through every sequence starts over."""
+        with self._locked() as state:
+            if state["seq_idx"] >= sequences:
+                state.update(self._fresh())
+            state["started"] = True
+            os.makedirs(self.checkpoints, exist_ok=True)
+            return state["seq_idx"]
+
+    def progress(self, seq_idx: int) -> Tuple[int, float]:
+        """Return how many loops of a sequence are done and the wall clock
+           time its next loop is due."""
+        with self._locked() as state:
+            seq = state["seqs"].get(str(seq_idx), {})
+            return seq.get("runs", 0), seq.get("due", 0)
+
+    def completed(self, seq_idx: int, test_idx: int) -> bool:
+        """Return True if a test has run in the current loop of its sequence."""
+        with self._locked() as state:
+            return test_idx in state["seqs"].get(str(seq_idx), {}).get("tests", [])
+
+    def checkpoint(self, seq_idx: int, test_idx: int) -> str:
+        return os.path.join(self.checkpoints, "%d-%d.json" % (seq_idx, test_idx))
+
+    def complete(self, seq_idx: int, test_idx: int):
+        with self._locked() as state:
+            seq = state["seqs"].setdefault(str(seq_idx), {})
+            seq.setdefault("tests", []).append(test_idx)
+        try:
+            os.unlink(self.checkpoint(seq_idx, test_idx))
+        except FileNotFoundError:
+            pass
+
+    def loop_done(self, seq_idx: int, due: float = 0):
+        """Record a loop of a sequence as done, the next one being due at
+           wall clock time `due`."""
+        with self._locked() as state:
+            seq = state["seqs"].setdefault(str(seq_idx), {})
+            seq.update(runs=seq.get("runs", 0) + 1, due=due, tests=[])
+
+    def seqs_done(self, seq_idx: int):
+        """Record every sequence before `seq_idx` as done."""
+        with self._locked() as state:
+            state["seq_idx"] = max(state["seq_idx"], seq_idx)
+            for k in list(state["seqs"]):
+                if int(k) < seq_idx:
+                    del state["seqs"][k]
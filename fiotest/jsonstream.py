@@ -0,0 +1,65 @@
+"""Incremental JSON encoding for request bodies too big to build in memory.
+
+Any iterable that isn't a list, tuple, dict or string is encoded as a JSON
+array one item at a time, so a generator-backed result set never has to
+exist as a whole. Such iterables should be re-iterable: a request that is
+retried encodes its body again.
+"""
+
+import json
+from typing import Iterable, Iterator
+
+_PLAIN = (str, bytes, int, float, bool, list, tuple, type(None))
+
+
+def iter_json(obj) -> Iterator[str]:
+    if isinstance(obj, dict):
+        yield "{"
+        for i, (key, val) in enumerate(obj.items()):
+            yield "%s%s: " % (", " if i else "", json.dumps(str(key)))
+            yield from iter_json(val)
+        yield "}"
+    elif not isinstance(obj, _PLAIN) and hasattr(obj, "__iter__"):
+        yield "["
+        for i, item in enumerate(obj):
+            if i:
+                yield ", "
+            yield from iter_json(item)
+        yield "]"
+    else:
+        yield json.dumps(obj)
+
+
+class JSONReader:
+    """A file-like read() over the encoding of `obj`, e.g. for curl's
+       READFUNCTION."""
+
+    def __init__(self, obj):
+        self._chunks = iter_json(obj)
+        self._buf = bytearray()
+
+    def read(self, size: int) -> bytes:
+        while len(self._buf) < size:
+            chunk = next(self._chunks, None)
+            if chunk is None:
+                break
+            self._buf += chunk.encode()
+        data = bytes(self._buf[:size])
+        del self._buf[:size]
+        return data
+
+
+class Concat:
+    """Re-iterable concatenation of several iterables."""
+
+    def __init__(self, *parts: Iterable):
+        self.parts = parts
+
+    def __iter__(self):
+        for part in self.parts:
+            yield from part
+
+
+def dumps(obj, **kwargs) -> str:
+    """json.dumps that also accepts lazily encoded iterables."""
+    return json.dumps(obj, default=list, **kwargs)
@@ -0,0 +1,123 @@
+"""Streaming a test's console.log to the device gateway while it runs.
+
+Without it nothing of a test's output is seen remotely until the test
+completes, and console.log is then uploaded in one burst. The streamer
+tails console.log on disk every few seconds and sends whatever was written
+since as one ranged PUT to the URL the log will be uploaded to. Once the
+log is past the head RotatingLog keeps in console.log, the compressed
+segments it rotates into are tailed the same way, so the end of a long
+test's output can be followed too. The files themselves are the buffer, so
+a slow or unavailable gateway never holds the test back and memory use is
+bounded by a single range. Ranges the gateway doesn't take are sent again,
+together with anything written in the meantime, at growing intervals.
+When the test is done the progress is handed to the final uploads, which
+then only send what is left.
+"""
+
+import logging
+import os
+from threading import Event, Thread
+from typing import Dict
+
+from fiotest.console import segments
+from fiotest.gateway_client import TRANSIENT, DeviceGatewayClient
+from fiotest.resumable import RangeSupport, UploadProgress
+
+log = logging.getLogger()
+MAX_INTERVAL = 300
+
+
+class LogStreamer:
+    def __init__(
+        self,
+        gateway: DeviceGatewayClient,
+        url: str,
+        path: str,
+        state_dir: str,
+        interval: float,
+        max_bytes: int,
+    ):
+        """Stream the log at `path`, and its segments, to the artifact
+           URLs under `url`."""
+        self.gateway = gateway
+        self.url = url
+        self.path = path
+        self.state_dir = state_dir
+        self.interval = interval
+        self.max_bytes = max_bytes
+        self.headers = {"Content-Type": "text/plain"}
+        self.offsets: Dict[str, int] = {}  # bytes the gateway has of each file
+        self.chunks = 0
+        self.enabled = RangeSupport(state_dir).get(url) is not False
+        self._stop = Event()
+        self._thread = Thread(target=self._run, daemon=True)
+
+    def start(self):
+        if self.enabled:
+            self._thread.start()
+
+    def _url(self, path: str) -> str:
+        return self.url + "/" + os.path.basename(path)
+
+    def _run(self):
+        delay = self.interval
+        while not self._stop.wait(delay):
+            if self._send():
+                delay = self.interval
+            else:
+                delay = min(MAX_INTERVAL, delay * 2)
+
+    def _send(self) -> bool:
+        """Send what was written since the last range. Returns False if the
+           gateway didn't take it."""
+        for path in [self.path] + segments(self.path):
+            try:
+                f = open(path, "rb")
+            except FileNotFoundError:
+                continue  # not started yet, or a segment rotated out
+            with f:
+                if not self._send_file(path, f):
+                    return False
+        return True
+
+    def _send_file(self, path: str, f) -> bool:
+        url = self._url(path)
+        offset = self.offsets.get(path, 0)
+        size = os.fstat(f.fileno()).st_size
+        while offset < size and not self._stop.is_set():
+            end = min(size, offset + self.max_bytes)
+            r, offset = self.gateway.append_range(url, f, self.headers, offset, end)
+            if r.status_code != 308:
+                if r.status_code not in TRANSIENT:
+                    # this test's logs aren't streamed, other uploads are fine
+                    log.warning(
+                        "Not streaming console.log, gateway answered HTTP_%d",
+                        r.status_code,
+                    )
+                    self.enabled = False
+                    self._stop.set()
+                return False
+            if not self.chunks:
+                # what put_file_resumable would have found out, it is only
+                # told which servers don't take ranges by its own probes
+                RangeSupport(self.state_dir).set(url, True)
+            self.offsets[path] = offset
+            self.chunks += 1
+        return True
+
+    def finish(self) -> int:
+        """Stop streaming and return how many bytes were streamed. The final
+           uploads of the logs resume from there."""
+        self._stop.set()
+        if self._thread.is_alive():
+            self._thread.join()
+        streamed = 0
+        for path, offset in self.offsets.items():
+            try:
+                size = os.path.getsize(path)
+            except FileNotFoundError:
+                continue  # rotated out, it won't be uploaded
+            if self.enabled and offset:
+                UploadProgress(self.state_dir, self._url(path)).save(size, offset)
+                streamed += offset
+        return streamed
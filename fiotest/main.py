@@ -1,17 +1,25 @@
 import argparse
 import logging
 import os
-from threading import Timer
+import subprocess
+import sys
+from threading import Lock, Timer
+from typing import Optional
 
 import yaml
 
+from fiotest.api import API
 from fiotest.callbacks import (
     AktualizrCallbackHandler,
     CallbackServer,
 )
+from fiotest.environment import fiotest_dir, kickoff_spread, worker_socket
 from fiotest.host import sudo_execute as host_sudo
+from fiotest.pacing import device_identity, kickoff_delay
+from fiotest.resources import delegate_controllers
 from fiotest.runner import SpecRunner
 from fiotest.spec import TestSpec
+from fiotest.spool import Spool, SpoolFlusher
 
 logging.basicConfig(level="INFO", format="%(asctime)s %(levelname)s: %(message)s")
 log = logging.getLogger()
@@ -25,8 +33,15 @@ class Coordinator(AktualizrCallbackHandler):
         self.timer.start()
         self.callbacks_enabled = False
         self.runner = None
+        self.kickoff: Optional[Timer] = None
+        # a kickoff fires on its own thread, racing the aklite callbacks
+        self._lock = Lock()
+        self._installs = 0
         self.spec = spec
-        if os.path.exists(SpecRunner.reboot_state):
+        journal = SpecRunner.open_journal(spec)
+        if os.path.exists(SpecRunner.reboot_state) or journal.unfinished(
+            len(spec.sequence)
+        ):
             self.runner = SpecRunner(self.spec)
             self.runner.start()
 
@@ -48,14 +63,41 @@ class Coordinator(AktualizrCallbackHandler):
             log.error("Unable to restart aktualizr-lite")
 
     def on_install_pre(self, current_target: str):
-        if self.runner:
-            log.info("New Target about to be installed, stopping testing")
-            self.runner.stop()
-            self.runner = None
+        with self._lock:
+            self._installs += 1
+            if self.kickoff:
+                self.kickoff.cancel()
+                self.kickoff = None
+            if self.runner and self.runner.running:
+                log.info("New Target about to be installed, stopping testing")
+                self.runner.stop()
 
     def on_install_post(self, current_target: str, status: str):
         if status == "OK":
+            # keeps a fleet updated at once from hitting the gateway at once
+            identity = device_identity("/var/sota")
+            delay = kickoff_delay(identity, current_target, kickoff_spread())
+            with self._lock:
+                installs = self._installs
+                if delay:
+                    log.info("New Target installed - kicking off testing in %ds", delay)
+                    self.kickoff = Timer(delay, self._start_runner, (installs,))
+                    self.kickoff.start()
+                    return
             log.info("New Target installed - kicking off testing")
+            self._start_runner(installs)
+
+    def _start_runner(self, installs: int):
+        with self._lock:
+            if installs != self._installs:
+                # another install began since this kickoff was scheduled
+                return
+            self.kickoff = None
+            if self.runner:
+                # two runners would race each other through the same journal
+                if self.runner.running:
+                    self.runner.stop()
+                self.runner.join()
             self.runner = SpecRunner(self.spec)
             self.runner.start()
 
@@ -98,7 +140,16 @@ callback_program = "%s"
 
 def main(spec: TestSpec):
     log.info("Test Spec is: %r", spec)
+    tests = [t for seq in spec.sequence for t in seq.tests or []]
+    if spec.limits or any(t.limits and not t.on_host for t in tests):
+        if not delegate_controllers():
+            log.warning("Resource limits of tests can't be enforced")
+    if worker_socket():
+        # fio-test-wrap hands tests to this so they skip a cold start
+        subprocess.Popen([sys.executable, "-m", "fiotest.worker"])
     coordinator = Coordinator(spec)
+    spool = Spool(os.path.join(fiotest_dir(), "spool"))
+    SpoolFlusher(spool, API("/var/sota", False)).start()
     cb_server = CallbackServer(coordinator)
     ensure_callbacks_configured(coordinator)
     cb_server.run_forever()
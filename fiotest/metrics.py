@@ -0,0 +1,101 @@
+"""Loading and summarizing the metrics tests write into $METRICS_DIR.
+
+A file holding a single number is reported as-is. Tests with many samples
+can append them to a time-series file instead:
+
+ * <name>.series - text, one sample per line (`echo $v >> lat.series`)
+ * <name>.f64 - raw little-endian float64 values
+
+Time-series are reduced to min/max/mean/p50/p95/p99 metrics.
+"""
+
+from array import array
+import os
+import shutil
+import sys
+from typing import Dict, Optional, Sequence, Union
+
+try:
+    import numpy
+except ImportError:  # optional dependency
+    numpy = None  # type: ignore
+
+# a numpy array when numpy is installed
+Series = Union[Sequence[float], "numpy.ndarray"]
+SERIES_SUFFIXES = (".series", ".f64")
+PERCENTILES = (50, 95, 99)
+
+
+def load_series(path: str) -> Series:
+    binary = path.endswith(".f64")
+    if numpy is not None:
+        if binary:
+            return numpy.fromfile(path, dtype="<f8")
+        return numpy.fromfile(path, dtype=float, sep=" ")
+
+    with open(path, "rb") as f:
+        if binary:
+            data = f.read()
+            # ignore a partial sample that is still being appended
+            samples = array("d", data[: len(data) - len(data) % 8])
+            if sys.byteorder == "big":
+                samples.byteswap()
+            return samples
+        return array("d", map(float, f.read().split()))
+
+
+def _percentile(ordered: Sequence[float], pct: float) -> float:
+    """Linear interpolation between closest ranks, like numpy's default."""
+    pos = (len(ordered) - 1) * pct / 100
+    low = int(pos)
+    high = min(low + 1, len(ordered) - 1)
+    return ordered[low] + (ordered[high] - ordered[low]) * (pos - low)
+
+
+def summarize(name: str, samples: Series) -> Dict[str, float]:
+    if not len(samples):
+        return {}
+    if numpy is not None:
+        pcts = numpy.percentile(samples, PERCENTILES)
+        summary = {
+            "min": float(numpy.min(samples)),
+            "max": float(numpy.max(samples)),
+            "mean": float(numpy.mean(samples)),
+        }
+    else:
+        ordered = sorted(samples)
+        pcts = [_percentile(ordered, p) for p in PERCENTILES]
+        summary = {
+            "min": ordered[0],
+            "max": ordered[-1],
+            "mean": sum(ordered) / len(ordered),
+        }
+    for pct, val in zip(PERCENTILES, pcts):
+        summary["p%d" % pct] = float(val)
+    return {"%s_%s" % (name, k): v for k, v in summary.items()}
+
+
+def attach(metrics_dir: str, attach_dir: str, prefix: str = ""):
+    """Copy the raw time-series files in `metrics_dir` into `attach_dir` as
+       "<prefix><file>"."""
+    for entry in os.scandir(metrics_dir):
+        if os.path.splitext(entry.name)[1] in SERIES_SUFFIXES:
+            shutil.copyfile(entry.path, os.path.join(attach_dir, prefix + entry.name))
+
+
+def collect(
+    metrics_dir: str, attach_dir: Optional[str] = None, prefix: str = ""
+) -> Dict[str, float]:
+    """Return the metrics in `metrics_dir`. Raw time-series files are copied
+       into `attach_dir` as "<prefix><file>" when it is given."""
+    if attach_dir:
+        attach(metrics_dir, attach_dir, prefix)
+    metrics: Dict[str, float] = {}
+    for entry in os.scandir(metrics_dir):
+        name, ext = os.path.splitext(entry.name)
+        if ext in SERIES_SUFFIXES:
+            metrics.update(summarize(name, load_series(entry.path)))
+        else:
+            with open(entry.path) as f:
+                metrics[entry.name] = float(f.read().strip())
+    return metrics
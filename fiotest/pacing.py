@@ -0,0 +1,136 @@
+"""Spreading a fleet's load on the device gateway.
+
+When a Target is rolled out to many devices they all finish installing
+within minutes of each other. Without pacing they would all start testing
+and reporting at once. Each device therefore delays its kickoff by an
+amount derived from its identity, spreading the fleet evenly over a
+window. On the device, gateway requests and uploaded bytes are limited by
+token buckets shared by every fiotest process. A Retry-After from the
+gateway holds all of them back.
+"""
+
+import hashlib
+import os
+import subprocess
+from time import sleep, time
+from typing import ContextManager, Dict
+
+from fiotest import statefile, trace
+from fiotest.environment import fiotest_dir
+
+
+def _sota_config(sota_dir: str) -> Dict[str, str]:
+    config = {}
+    try:
+        with open(os.path.join(sota_dir, "sota.toml")) as f:
+            for line in f:
+                key, _, val = line.partition("=")
+                if '"' in val:
+                    config[key.strip()] = val.split('"')[1]
+    except FileNotFoundError:
+        pass
+    return config
+
+
+def _hsm_certificate(config: Dict[str, str]) -> bytes:
+    """Return the client certificate kept in the device's HSM."""
+    args = ["pkcs11-tool", "--module", config["module"]]
+    args += ["--token-label", "aktualizr", "--read-object", "--type", "cert"]
+    args += ["--id", config["tls_clientcert_id"]]
+    if config.get("pass"):
+        args += ["--login", "--pin", config["pass"]]
+    try:
+        return subprocess.check_output(args, stderr=subprocess.DEVNULL)
+    except (OSError, subprocess.CalledProcessError):
+        return b""
+
+
+def _read(path: str) -> bytes:
+    try:
+        with open(path, "rb") as f:
+            return f.read().strip()
+    except OSError:
+        return b""
+
+
+def device_identity(sota_dir: str) -> bytes:
+    """Return something unique to this device that survives the container
+       being recreated: its client certificate, from the HSM on pkcs11
+       devices, else the host's machine id when it is bind mounted. As a
+       last resort a random id is kept in the fiotest dir."""
+    config = _sota_config(sota_dir)
+    if config.get("pkey_source") == "pkcs11":
+        if config.get("module") and config.get("tls_clientcert_id"):
+            identity = _hsm_certificate(config)
+            if identity:
+                return identity
+    else:
+        cert = config.get("tls_clientcert_path", os.path.join(sota_dir, "client.pem"))
+        identity = _read(cert)
+        if identity:
+            return identity
+    identity = _read("/etc/machine-id")
+    if identity:
+        return identity
+
+    path = os.path.join(fiotest_dir(), "device-id")
+    identity = _read(path)
+    if not identity:
+        identity = os.urandom(16).hex().encode()
+        tmp = path + ".tmp"
+        with open(tmp, "wb") as f:
+            f.write(identity)
+        os.replace(tmp, path)
+    return identity
+
+
+def kickoff_delay(identity: bytes, target: str, spread: int) -> float:
+    """Seconds this device waits before testing `target`. The same device
+       always gets the same delay for a Target, and a fleet's delays are
+       spread uniformly over `spread` seconds."""
+    if spread <= 0:
+        return 0
+    h = hashlib.blake2b(identity + b"\0" + target.encode(), digest_size=8)
+    return int.from_bytes(h.digest(), "big") / 2 ** 64 * spread
+
+
+class Pacer:
+    """Token buckets for gateway requests and uploaded bytes, refilled at
+       `request_rate` per second and `upload_rate` bytes per second. Each
+       holds one second's worth. A rate of 0 is unlimited."""
+
+    def __init__(self, path: str, request_rate: float = 0, upload_rate: float = 0):
+        self.path = path
+        self.rates = {"requests": request_rate, "bytes": upload_rate}
+
+    def _locked(self) -> ContextManager[dict]:
+        return statefile.locked(self.path, {"hold": 0})
+
+    def reserve(self, upload_bytes: int = 0) -> float:
+        """Take a request, sending `upload_bytes`, from the buckets and
+           return how many seconds to wait before making it. Requests
+           bigger than a bucket run it into debt that later ones wait out."""
+        now = time()
+        with self._locked() as state:
+            wait = max(0.0, state["hold"] - now)
+            for name, n in (("requests", 1), ("bytes", upload_bytes)):
+                rate = self.rates[name]
+                if not rate or not n:
+                    continue
+                tokens, last = state.get(name, (rate, now))
+                tokens = min(rate, tokens + (now - last) * rate) - n
+                state[name] = (tokens, now)
+                if tokens < 0:
+                    wait = max(wait, -tokens / rate)
+            return wait
+
+    def wait(self, upload_bytes: int = 0):
+        seconds = self.reserve(upload_bytes)
+        if seconds > 0:
+            with trace.span("pace", seconds=seconds):
+                sleep(seconds)
+
+    def hold(self, seconds: float):
+        """Make every process wait `seconds` before its next request."""
+        with self._locked() as state:
+            state["hold"] = max(state["hold"], time() + seconds)
@@ -0,0 +1,71 @@
+"""Event driven supervision of test processes."""
+
+import logging
+import os
+import selectors
+import signal
+import subprocess
+from threading import Thread
+from typing import Optional
+
+log = logging.getLogger()
+
+
+def _exit_fd(p: subprocess.Popen) -> int:
+    """Return a file descriptor that becomes readable when `p` exits."""
+    try:
+        return os.pidfd_open(p.pid)  # type: ignore
+    except (AttributeError, OSError):
+        # pidfd_open needs Python 3.9 and Linux 5.3. Fall back to a thread
+        # that closes the write end of a pipe once the process has exited.
+        r, w = os.pipe()
+
+        def waiter():
+            p.wait()
+            os.close(w)
+
+        Thread(target=waiter, daemon=True).start()
+        return r
+
+
+class Supervised:
+    """Wraps a process started with `start_new_session=True` so that its
+       whole process group can be signalled."""
+
+    def __init__(self, p: subprocess.Popen):
+        self.p = p
+        self._fd = _exit_fd(p)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        os.close(self._fd)
+
+    def wait(self, stop_fd: Optional[int] = None, timeout: Optional[float] = None):
+        """Block until the process exits, `stop_fd` becomes readable or the
+           timeout expires. Returns True if the process has exited."""
+        with selectors.DefaultSelector() as sel:
+            sel.register(self._fd, selectors.EVENT_READ)
+            if stop_fd is not None:
+                sel.register(stop_fd, selectors.EVENT_READ)
+            events = sel.select(timeout)
+        if any(key.fd == self._fd for key, _ in events):
+            self.p.wait()
+            return True
+        return False
+
+    def _signal(self, sig: int):
+        try:
+            os.killpg(self.p.pid, sig)
+        except ProcessLookupError:
+            pass
+
+    def terminate(self, grace: float) -> int:
+        """Send SIGTERM to the process group and escalate to SIGKILL if it
+           hasn't exited within `grace` seconds."""
+        self._signal(signal.SIGTERM)
+        if not self.wait(timeout=grace):
+            log.warning("Process %d ignored SIGTERM, killing it", self.p.pid)
+            self._signal(signal.SIGKILL)
+        return self.p.wait()
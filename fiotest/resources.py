@@ -0,0 +1,325 @@
+"""Measuring what a test's process tree costs to run, and limiting it.
+
+Every test gets the figures `wait4` reports for it. When the container can
+create cgroup v2 groups, the test also runs in a group of its own. That
+accounts for processes the test leaves running in the background and
+gives exact block I/O and peak memory numbers. The group also enforces
+the test's resource limits and counts how often they held the test back.
+
+on_host tests get the same limits from a transient systemd scope on the
+host. Their throttling counters come back on a marker line at the end of
+their output.
+"""
+
+import logging
+import os
+import resource
+import shlex
+from time import monotonic
+from typing import Dict, List, Optional
+
+log = logging.getLogger()
+
+CGROUP_ROOT = "/sys/fs/cgroup"
+# where the container's own processes go so its tests can have controllers
+DELEGATED_LEAF = "fiotest"
+CPU_PERIOD = 100000  # microseconds
+HOST_STATS_MARKER = "fiotest-cgroup-stats:"
+IONICE_CLASSES = {"realtime": 1, "best-effort": 2, "idle": 3}
+
+
+def _own_cgroup() -> Optional[str]:
+    """Return the cgroup v2 directory this process is in, if there is one."""
+    try:
+        with open("/proc/self/cgroup") as f:
+            for line in f:
+                hierarchy, _, path = line.rstrip("\n").split(":", 2)
+                if hierarchy == "0":
+                    return os.path.join(CGROUP_ROOT, path.lstrip("/"))
+    except OSError:
+        pass
+    return None
+
+
+def delegate_controllers() -> bool:
+    """Make the cpu, memory and io controllers available to the groups of
+       tests. cgroup v2 only hands controllers down from a group without
+       processes of its own, so the container's processes are moved into a
+       leaf group first. Returns False if that isn't possible here."""
+    own = _own_cgroup()
+    if not own or not os.path.exists(os.path.join(own, "cgroup.subtree_control")):
+        return False
+    if os.path.basename(own) == DELEGATED_LEAF:
+        own = os.path.dirname(own)  # done before this container restarted
+    leaf = os.path.join(own, DELEGATED_LEAF)
+    try:
+        os.makedirs(leaf, exist_ok=True)
+        with open(os.path.join(own, "cgroup.procs")) as f:
+            pids = f.read().split()
+        for pid in pids:
+            try:
+                with open(os.path.join(leaf, "cgroup.procs"), "w") as f:
+                    f.write(pid)
+            except OSError:
+                pass  # it has exited
+        with open(os.path.join(own, "cgroup.controllers")) as f:
+            available = f.read().split()
+        wanted = ["+" + c for c in ("cpu", "memory", "io") if c in available]
+        with open(os.path.join(own, "cgroup.subtree_control"), "w") as f:
+            f.write(" ".join(wanted))
+    except OSError as e:
+        log.warning("Unable to delegate cgroup controllers to tests: %s", e)
+        return False
+    return True
+
+
+def _tests_cgroup() -> Optional[str]:
+    """Return the group the groups of tests are created in."""
+    own = _own_cgroup()
+    if own and os.path.basename(own) == DELEGATED_LEAF:
+        return os.path.dirname(own)
+    return own
+
+
+def _limit_files(limits: dict) -> Dict[str, str]:
+    files = {}
+    if limits.get("cpu_weight") is not None:
+        files["cpu.weight"] = str(limits["cpu_weight"])
+    if limits.get("cpu_max") is not None:
+        files["cpu.max"] = "%d %d" % (limits["cpu_max"] * CPU_PERIOD, CPU_PERIOD)
+    if limits.get("memory_max") is not None:
+        files["memory.max"] = str(limits["memory_max"])
+    if limits.get("io_weight") is not None:
+        files["io.weight"] = "default %d" % limits["io_weight"]
+    return files
+
+
+def priority_args(limits: dict) -> List[str]:
+    """Return the nice and ionice command prefix for `limits`."""
+    args = []
+    if limits.get("nice") is not None:
+        args += ["nice", "-n", str(limits["nice"])]
+    if limits.get("ionice_class"):
+        cls = IONICE_CLASSES[limits["ionice_class"]]
+        args += ["ionice", "-c", str(cls)]
+        if limits.get("ionice_level") is not None and cls != 3:
+            args += ["-n", str(limits["ionice_level"])]
+    return args
+
+
+def host_command(command: List[str], limits: dict) -> str:
+    """Return the shell command that runs an on_host test in a transient
+       systemd scope enforcing `limits`. The test runs as the fio user. The
+       scope's throttling counters are printed on a line starting with
+       HOST_STATS_MARKER before it exits."""
+    props = []
+    if limits.get("cpu_weight") is not None:
+        props.append("CPUWeight=%d" % limits["cpu_weight"])
+    if limits.get("cpu_max") is not None:
+        props.append("CPUQuota=%d%%" % (limits["cpu_max"] * 100))
+    if limits.get("memory_max") is not None:
+        props.append("MemoryMax=%s" % limits["memory_max"])
+    if limits.get("io_weight") is not None:
+        props.append("IOWeight=%d" % limits["io_weight"])
+    # like the login shell that would have run the command on its own
+    script = " ".join(priority_args(limits) + command)
+    script += "; rc=$?; cg=/sys/fs/cgroup$(cut -d: -f3 /proc/self/cgroup)"
+    script += "; echo %s $({ cat $cg/cpu.stat $cg/memory.events" % HOST_STATS_MARKER
+    script += "; for r in cpu io memory; do"
+    script += ' sed -n "s/^some .*total=/${r}_stall_usec /p" $cg/$r.pressure'
+    script += "; done; } 2>/dev/null); exit $rc"
+    args = ["systemd-run", "--scope", "--quiet", "--uid=fio"]
+    args += ["-p" + prop for prop in props]
+    args += ["--", "sh", "-c", script]
+    return "echo fio | sudo -S -p '' " + " ".join(shlex.quote(a) for a in args)
+
+
+def _throttling(cpu: Dict[str, int], events: Dict[str, int]) -> Dict[str, float]:
+    metrics: Dict[str, float] = {}
+    if "nr_throttled" in cpu:
+        metrics["cpu_throttled_periods"] = cpu["nr_throttled"]
+        metrics["cpu_throttled_seconds"] = cpu["throttled_usec"] / 1e6
+    if events:
+        # times the test hit memory.high/max and had to reclaim, or was killed
+        metrics["memory_high_events"] = events.get("high", 0)
+        metrics["memory_max_events"] = events.get("max", 0)
+        metrics["oom_kills"] = events.get("oom_kill", 0)
+    return metrics
+
+
+def parse_host_stats(tail: bytes) -> Dict[str, float]:
+    """Return the throttling metrics from a HOST_STATS_MARKER line in the
+       last lines of an on_host test's output."""
+    marker = HOST_STATS_MARKER.encode()
+    for line in reversed(tail.splitlines()):
+        if line.startswith(marker):
+            break
+    else:
+        return {}
+    # "<key> <value>" pairs from cpu.stat, memory.events and the PSI files
+    fields = line[len(marker) :].decode(errors="replace").split()
+    counters: Dict[str, int] = {}
+    for key, val in zip(fields[::2], fields[1::2]):
+        if val.isdigit():
+            counters[key] = int(val)
+    events = {k: v for k, v in counters.items() if k in ("high", "max", "oom_kill")}
+    metrics = _throttling(counters, events)
+    for res in ("cpu", "io", "memory"):
+        if res + "_stall_usec" in counters:
+            metrics[res + "_stall_seconds"] = counters[res + "_stall_usec"] / 1e6
+    return metrics
+
+
+class TestCgroup:
+    """A cgroup v2 group for a single test. Use `enter` as the test's
+       `preexec_fn` so that everything it starts is accounted to it and
+       held to `limits`."""
+
+    def __init__(self, name: str, limits: Optional[dict] = None):
+        self.path: Optional[str] = None
+        self.limits = limits or {}
+        parent = _tests_cgroup()
+        if not parent or not os.path.exists(os.path.join(parent, "cgroup.procs")):
+            if _limit_files(self.limits):
+                log.warning("cgroup v2 isn't available, not limiting %s", name)
+            return
+        path = os.path.join(parent, "%s-%d" % (name, os.getpid()))
+        try:
+            os.mkdir(path)
+            self.path = path
+        except OSError as e:
+            log.debug("Unable to create cgroup %s: %s", path, e)
+            return
+        for fname, val in _limit_files(self.limits).items():
+            try:
+                with open(os.path.join(path, fname), "w") as f:
+                    f.write(val)
+            except OSError as e:
+                log.warning("Unable to set %s of %s to %s: %s", fname, name, val, e)
+
+    def enter(self):
+        if self.path:
+            try:
+                with open(os.path.join(self.path, "cgroup.procs"), "w") as f:
+                    f.write("0")
+            except OSError:
+                pass  # the test still runs, it just isn't in the group
+
+    def _read(self, name: str) -> Dict[str, int]:
+        assert self.path  # for mypy
+        vals: Dict[str, int] = {}
+        try:
+            with open(os.path.join(self.path, name)) as f:
+                for line in f:
+                    fields = line.split()
+                    if len(fields) == 1:
+                        vals[name] = int(fields[0])
+                    elif len(fields) == 2:
+                        vals[fields[0]] = int(fields[1])
+                    else:  # io.stat: "<maj:min> rbytes=.. wbytes=.. ..."
+                        for field in fields[1:]:
+                            key, val = field.split("=", 1)
+                            vals[key] = vals.get(key, 0) + int(val)
+        except (OSError, ValueError):
+            pass
+        return vals
+
+    def usage(self) -> Dict[str, float]:
+        if not self.path:
+            return {}
+        metrics: Dict[str, float] = {}
+        cpu = self._read("cpu.stat")
+        if "user_usec" in cpu:
+            metrics["cpu_user_seconds"] = cpu["user_usec"] / 1e6
+            metrics["cpu_system_seconds"] = cpu["system_usec"] / 1e6
+        peak = self._read("memory.peak")  # Linux 5.19+
+        if "memory.peak" in peak:
+            metrics["max_rss_bytes"] = peak["memory.peak"]
+        io = self._read("io.stat")
+        if io:
+            metrics["io_read_bytes"] = io.get("rbytes", 0)
+            metrics["io_write_bytes"] = io.get("wbytes", 0)
+        metrics.update(_throttling(cpu, self._read("memory.events")))
+        for res in ("cpu", "io", "memory"):
+            stall = self._stall(res)
+            if stall is not None:
+                metrics[res + "_stall_seconds"] = stall
+        return metrics
+
+    def _stall(self, res: str) -> Optional[float]:
+        """Seconds some of the test's tasks waited on `res` (PSI)."""
+        assert self.path  # for mypy
+        try:
+            with open(os.path.join(self.path, res + ".pressure")) as f:
+                for line in f:
+                    fields = line.split()
+                    if fields[0] == "some":
+                        return int(fields[-1].split("=")[1]) / 1e6
+        except (OSError, ValueError, IndexError):
+            pass
+        return None
+
+    def remove(self):
+        if self.path:
+            try:
+                os.rmdir(self.path)
+                self.path = None
+            except OSError as e:
+                # a process the test left behind is still in it
+                log.warning("Unable to remove cgroup %s: %s", self.path, e)
+
+
+def rusage_metrics(ru: resource.struct_rusage) -> Dict[str, float]:
+    return {
+        "cpu_user_seconds": ru.ru_utime,
+        "cpu_system_seconds": ru.ru_stime,
+        "max_rss_bytes": ru.ru_maxrss * 1024,
+        # rusage counts 512 byte blocks that really hit the block layer
+        "io_read_bytes": ru.ru_inblock * 512,
+        "io_write_bytes": ru.ru_oublock * 512,
+        "voluntary_context_switches": ru.ru_nvcsw,
+        "involuntary_context_switches": ru.ru_nivcsw,
+    }
+
+
+class ResourceMonitor:
+    """Measures a test from `start` until `stop` is called with the rusage
+       of its reaped process. cgroup figures win over the rusage ones since
+       they include processes the test did not wait for. For an `on_host`
+       test the process here is only its ssh client, so just the wall time
+       and the stats the host reports are kept."""
+
+    def __init__(
+        self,
+        name: str = "fiotest",
+        limits: Optional[dict] = None,
+        on_host: bool = False,
+    ):
+        self.cgroup = TestCgroup(name, limits)
+        self.on_host = on_host
+        self._started = 0.0
+        self.metrics: Dict[str, float] = {}
+
+    def start(self):
+        self._started = monotonic()
+
+    def stop(
+        self, ru: Optional[resource.struct_rusage], output_tail: bytes = b""
+    ) -> Dict[str, float]:
+        """`output_tail` is the end of the test's output, where an on_host
+           test reports its throttling."""
+        self.metrics = {"wall_seconds": monotonic() - self._started}
+        if not self.on_host:
+            if ru is not None:
+                self.metrics.update(rusage_metrics(ru))
+            self.metrics.update(self.cgroup.usage())
+        self.metrics.update(parse_host_stats(output_tail))
+        self.cgroup.remove()
+        return self.metrics
+
+
+def wait(pid: int):
+    """Reap `pid` like Popen.wait but also return its rusage. Returns
+       (exit code, rusage)."""
+    _, wstatus, ru = os.wait4(pid, 0)
+    return os.waitstatus_to_exitcode(wstatus), ru
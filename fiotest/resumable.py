@@ -0,0 +1,85 @@
+"""Bookkeeping for artifact uploads that are sent in ranges and can be
+resumed.
+
+Progress is persisted under the fiotest dir after every range the server
+acknowledges. A later attempt, even from another process after a reboot or
+container restart, asks the server how much it has and continues from
+there instead of starting over.
+"""
+
+import hashlib
+import os
+from time import time
+from typing import Optional
+from urllib.parse import urlsplit
+
+from fiotest import statefile
+
+
+class UploadProgress:
+    def __init__(self, state_dir: str, url: str):
+        os.makedirs(state_dir, exist_ok=True)
+        # signed URLs can change between attempts, their path doesn't
+        key = url.split("?", 1)[0].encode()
+        name = hashlib.blake2b(key, digest_size=16).hexdigest()
+        self.path = os.path.join(state_dir, name + ".json")
+        self.url = url
+
+    def load(self, size: int) -> Optional[int]:
+        """Return the offset an earlier attempt to upload `size` bytes got
+           to, if there was one."""
+        state = statefile.read(self.path)
+        if not state:
+            return None
+        return state["offset"] if state["size"] == size else None
+
+    def save(self, size: int, offset: int):
+        statefile.write(self.path, {"url": self.url, "size": size, "offset": offset})
+
+    def remove(self):
+        try:
+            os.unlink(self.path)
+        except FileNotFoundError:
+            pass
+
+
+def prune(state_dir: str, max_age: int = 7 * 24 * 3600):
+    """Forget uploads nobody has tried to finish in `max_age` seconds."""
+    try:
+        names = os.listdir(state_dir)
+    except FileNotFoundError:
+        return
+    for name in names:
+        path = os.path.join(state_dir, name)
+        try:
+            if name != "servers.json" and os.path.getmtime(path) < time() - max_age:
+                os.unlink(path)
+        except FileNotFoundError:
+            pass  # pruned by another process
+
+
+class RangeSupport:
+    """Remembers which servers accept ranged uploads so the capability only
+       has to be probed once."""
+
+    def __init__(self, state_dir: str):
+        os.makedirs(state_dir, exist_ok=True)
+        self.path = os.path.join(state_dir, "servers.json")
+
+    def _load(self) -> dict:
+        return statefile.read(self.path, {})
+
+    def get(self, url: str) -> Optional[bool]:
+        return self._load().get(urlsplit(url).netloc)
+
+    def set(self, url: str, supported: bool):
+        servers = self._load()
+        servers[urlsplit(url).netloc] = supported
+        statefile.write(self.path, servers)
+
+
+def committed(range_header: Optional[str]) -> int:
+    """Return how many bytes a server has from its "Range: bytes=0-N"."""
+    if not range_header:
+        return 0
+    return int(range_header.split("-")[-1]) + 1
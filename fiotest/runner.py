@@ -1,14 +1,24 @@
+import heapq
 import json
 import logging
-from os import execv, unlink
+import os
+import re
+import select
 import subprocess
-from threading import Thread
-from time import sleep
+from threading import Condition, Lock, Thread, current_thread
+from time import monotonic, time
+from typing import List, Set, Tuple
 
 import netifaces
 
+from fiotest import host, trace
 from fiotest.api import API
+from fiotest.environment import fiotest_dir, trace_results
+from fiotest.journal import RunJournal, read_checkpoint
+from fiotest.process import Supervised
+from fiotest.resources import host_command
 from fiotest.spec import Reboot, Sequence, Test, TestSpec
+from fiotest.spool import Spool, SpoolFlusher
 
 log = logging.getLogger()
 
@@ -19,12 +29,31 @@ class SpecStopped(Exception):
 
 class SpecRunner:
     reboot_state = "/var/lib/fiotest/reboot.state"
+    ssh_control_path = "/tmp/fiotest-ssh-master"
+    kill_grace_seconds = 10
 
     def __init__(self, spec: TestSpec):
         self.spec = spec
         self.running = False
         self.thread = Thread(target=self.run)
+        # stop() writes to this pipe to wake up everything supervising a test
+        self._stop_r, self._stop_w = os.pipe()
         self.api = API("/var/sota", False)
+        spool = Spool(os.path.join(fiotest_dir(), "spool"))
+        self.flusher = SpoolFlusher(spool, self.api, batch=100)
+        self.journal = self.open_journal(spec)
+        self._ssh_lock = Lock()
+        self.ssh_masters = 0
+        self.ssh_reuses = 0
+
+    @staticmethod
+    def open_journal(spec: TestSpec) -> RunJournal:
+        path = os.path.join(fiotest_dir(), "run-journal.json")
+        return RunJournal(path, API.target_name("/var/sota"), spec.json())
+
+    def __del__(self):
+        os.close(self._stop_r)
+        os.close(self._stop_w)
 
     def start(self):
         self.running = True
@@ -40,36 +69,58 @@ class SpecRunner:
                     "Detectected rebooted sequence, continuing after sequence %d",
                     completed,
                 )
-            unlink(self.reboot_state)
+            os.unlink(self.reboot_state)
             self.api.complete_test(data["test_id"], {})
         except FileNotFoundError:
             pass  # This is the "normal" case - no reboot has occurred
 
         try:
-            for i, seq in enumerate(self.spec.sequence):
+            sequences = self.spec.sequence
+            resumed = self.journal.begin(len(sequences))
+            if resumed > completed:
+                log.warning("Resuming interrupted run at sequence %d", resumed)
+                completed = resumed
+            if completed:
+                log.debug("Skipping seqs 0-%d", completed - 1)
+            i = completed
+            while i < len(sequences):
                 self._assert_running()
-                if i < completed:
-                    log.debug("Skipping seq %d", i)
-                    continue
-                log.info("Executing seq %d", i)
+                seq = sequences[i]
                 if seq.reboot:
+                    log.info("Executing seq %d", i)
                     self._reboot(i, seq.reboot)
-                else:
-                    # run_tests recursively decrements seq.repeat.total
-                    # we need to keep a copy of this value so that testing
-                    # can be repeated
-                    if seq.repeat:
-                        total = seq.repeat.total
-                    self._run_tests(seq)
-                    if seq.repeat:
-                        seq.repeat.total = total
+                    i += 1
+                    continue
+                group = [i]
+                while self._interleaved(seq) and i + len(group) < len(sequences):
+                    if not self._interleaved(sequences[i + len(group)]):
+                        break
+                    group.append(i + len(group))
+                self._run_scheduled(group)
+                i += len(group)
+                self.journal.seqs_done(i)
         except SpecStopped:
             log.warning("Sequence has been stopped before completion")
+        if self.ssh_masters:
+            log.info(
+                "Host SSH: %d master connections, %d reused by on_host tests",
+                self.ssh_masters,
+                self.ssh_reuses,
+            )
+        host_stats = host.stats()
+        if host_stats and host_stats["channels"]:
+            log.info(
+                "Host commands: %(channels)d channels on %(connects)d connections"
+                " (%(reused)d reused), opened in %(channel_open_avg_seconds).3fs"
+                " on average",
+                host_stats,
+            )
         log.info("Testing complete")
 
     def stop(self):
         log.info("Stopping run")
         self.running = False
+        os.write(self._stop_w, b"x")
 
     def join(self):
         self.thread.join()
@@ -84,46 +135,255 @@ class SpecRunner:
         with open(self.reboot_state, "w") as f:
             state = {"seq_idx": seq_idx + 1, "test_id": test_id}
             json.dump(state, f)
-        execv(reboot.command[0], reboot.command)
+        self.journal.seqs_done(seq_idx + 1)
+        os.execv(reboot.command[0], reboot.command)
+
+    def _ssh_master_alive(self, args: List[str], host_ip: str) -> bool:
+        if not os.path.exists(self.ssh_control_path):
+            return False
+        rc = subprocess.call(
+            args + ["-O", "check", "fio@" + host_ip],
+            stdin=subprocess.DEVNULL,
+            stdout=subprocess.DEVNULL,
+            stderr=subprocess.DEVNULL,
+        )
+        return rc == 0
 
-    def _run_test(self, test: Test):
-        host_ip = netifaces.gateways()["default"][netifaces.AF_INET][0]
+    def _ssh_args(self, host_ip: str) -> List[str]:
+        """Return the ssh command used for on_host tests. The tests run as
+           children of fio-test-wrap so they can't use the asyncssh connection
+           in this process. Instead they share an OpenSSH control master owned
+           by the runner, so only the first test pays for the handshake."""
+        args = ["sshpass", "-pfio", "ssh", "-o", "StrictHostKeyChecking no"]
+        args.extend(["-o", "ControlPath=" + self.ssh_control_path])
+        with self._ssh_lock:
+            if self._ssh_master_alive(args, host_ip):
+                self.ssh_reuses += 1
+            else:
+                # a socket left behind by a dead master, e.g. from before a
+                # container restart, would keep a new one from starting
+                try:
+                    os.unlink(self.ssh_control_path)
+                except FileNotFoundError:
+                    pass
+                # The master must be started with its stdio detached.
+                # Otherwise it would keep the test's output pipe open.
+                start = monotonic()
+                rc = subprocess.call(
+                    args
+                    + ["-o", "ControlMaster=yes", "-o", "ControlPersist=600"]
+                    + ["-fN", "fio@" + host_ip],
+                    stdin=subprocess.DEVNULL,
+                    stdout=subprocess.DEVNULL,
+                    stderr=subprocess.DEVNULL,
+                )
+                if rc == 0:
+                    self.ssh_masters += 1
+                    log.info("Host SSH master started in %.3fs", monotonic() - start)
+                else:
+                    log.warning("Unable to start host SSH master: %d", rc)
+        # With ControlMaster=no ssh still uses the master when it exists and
+        # falls back to a normal connection when it doesn't.
+        return args + ["-o", "ControlMaster=no", "fio@" + host_ip]
+
+    def _flush_results(self):
+        """Send the results a batched sequence has spooled. Anything that
+           can't be delivered now is left to the background spool flusher."""
+        with trace.span("flush_results"):
+            while self.flusher.flush() == self.flusher.batch:
+                pass
+
+    @staticmethod
+    def _log_path(seq_idx: int, test_idx: int, test: Test) -> str:
+        name = re.sub(r"[^\w.-]", "_", test.name)
+        return "/tmp/fiotest-%d-%d-%s.log" % (seq_idx, test_idx, name)
+
+    def _run_once(self, seq_idx: int, test_idx: int, test: Test, spool: bool):
+        """Run a test and record it in the journal. A test whose results
+           were handed off before the runner was interrupted isn't run again."""
+        checkpoint = self.journal.checkpoint(seq_idx, test_idx)
+        if read_checkpoint(checkpoint).get("reported"):
+            log.info("Test %s was reported before an interruption", test.name)
+        else:
+            log_path = self._log_path(seq_idx, test_idx, test)
+            self._run_test(test, log_path, spool, checkpoint)
+            self._assert_running()  # a killed test runs again on resume
+        self.journal.complete(seq_idx, test_idx)
+
+    def _run_test(
+        self, test: Test, log_path: str, spool: bool = False, checkpoint: str = ""
+    ):
         args = ["/usr/local/bin/fio-test-wrap", test.name]
+        env = dict(os.environ)
+        if spool:
+            env["FIO_TEST_SPOOL"] = "1"
+        if checkpoint:
+            env["FIO_TEST_CHECKPOINT"] = checkpoint
+        limits = self.spec.test_limits(test)
         if test.on_host:
-            args.extend(
-                [
-                    "sshpass",
-                    "-pfio",
-                    "ssh",
-                    "-o",
-                    "StrictHostKeyChecking no",
-                    "fio@" + host_ip,
-                ]
+            env["FIO_TEST_ON_HOST"] = "1"
+            host_ip = netifaces.gateways()["default"][netifaces.AF_INET][0]
+            args.extend(self._ssh_args(host_ip))
+        if limits and test.on_host:
+            # enforced on the host, in a systemd scope of its own
+            args.append(host_command(test.command, limits.dict(exclude_unset=True)))
+        else:
+            args.extend(test.command)
+            if limits:
+                env["FIO_TEST_LIMITS"] = limits.json(exclude_unset=True)
+        with open(log_path, "wb") as f:
+            self._assert_running()
+            started = time()
+            with trace.span("test", test=test.name, on_host=test.on_host) as span:
+                p = subprocess.Popen(
+                    args, stderr=f, stdout=f, env=env, start_new_session=True
+                )
+                with Supervised(p) as proc:
+                    if proc.wait(self._stop_r):
+                        rc = p.returncode
+                    else:
+                        log.info("Killing test %s", test.name)
+                        rc = proc.terminate(self.kill_grace_seconds)
+                span["rc"] = rc
+            ended = time()
+            log.info(
+                "Test %s ran from %.6f to %.6f (%.3fs)",
+                test.name,
+                started,
+                ended,
+                ended - started,
             )
-        args.extend(test.command)
-        with open("/tmp/tmp.log", "wb") as f:
-            p = subprocess.Popen(args, stderr=f, stdout=f)
-            while p.poll() is None:
-                if not self.running:
-                    log.info("Killing test")
-                    p.kill()
-                    return
-                sleep(1)
-            rc = p.wait()
             if rc != 0:
-                log.error("Test exited with %d", rc)
+                log.error("Test %s exited with %d", test.name, rc)
 
-    def _run_tests(self, seq: Sequence):
-        if seq.tests:
-            for test in seq.tests:
-                self._assert_running()
+    def _run_parallel(self, seq_idx: int, seq: Sequence):
+        """Run the tests of a sequence on up to `seq.parallel` workers. Tests
+           are started in order unless they would share an exclusive tag with
+           a test that is still running."""
+        assert seq.tests  # for mypy
+        pending: List[Tuple[int, Test]] = [
+            (test_idx, test)
+            for test_idx, test in enumerate(seq.tests)
+            if not self.journal.completed(seq_idx, test_idx)
+        ]
+        held: Set[str] = set()
+        workers: List[Thread] = []
+        errors: List[Exception] = []  # raised here like the sequential path
+        cond = Condition()
+
+        def worker(test_idx: int, test: Test):
+            try:
+                self._run_once(seq_idx, test_idx, test, seq.batch)
+            except SpecStopped:
+                pass
+            except Exception as e:
+                with cond:
+                    errors.append(e)
+            finally:
+                with cond:
+                    held.difference_update(test.exclusive)
+                    workers.remove(current_thread())
+                    cond.notify()
+
+        with cond:
+            while pending or workers:
+                if not self.running:
+                    # stop() has killed the tests, wait for workers to notice
+                    while workers:
+                        cond.wait()
+                    raise SpecStopped()
+                if errors:
+                    # start nothing else, let the running tests finish
+                    while workers:
+                        cond.wait()
+                    raise errors[0]
+                ready = None
+                if len(workers) < seq.parallel:
+                    for item in pending:
+                        if held.isdisjoint(item[1].exclusive):
+                            ready = item
+                            break
+                if ready is None:
+                    cond.wait(1)
+                    continue
+                pending.remove(ready)
+                test_idx, test = ready
                 log.info("Executing test: %s", test.name)
-                self._run_test(test)
+                held.update(test.exclusive)
+                thread = Thread(target=worker, args=(test_idx, test))
+                workers.append(thread)
+                thread.start()
+        # a stop() that killed the last tests leaves nothing pending
+        self._assert_running()
 
-        if seq.repeat and seq.repeat.total != 1:
-            if seq.repeat.total > 0:
-                seq.repeat.total -= 1
-            self._assert_running()
-            log.info("Repeating sequence in %d seconds", seq.repeat.delay_seconds)
-            sleep(seq.repeat.delay_seconds)
-            self._run_tests(seq)
+    def _sleep(self, seconds: float):
+        """Sleep unless stop() is called first."""
+        if seconds > 0:
+            select.select([self._stop_r], [], [], seconds)
+        self._assert_running()
+
+    @staticmethod
+    def _interleaved(seq: Sequence) -> bool:
+        return bool(seq.repeat and seq.repeat.interleave and not seq.reboot)
+
+    def _run_scheduled(self, seq_idxs: List[int]):
+        """Run the given sequences until each has been repeated as often as
+           its spec says. Runs are kept on a single monotonic timeline so
+           several sequences can repeat side by side, and fixed-rate ones
+           don't drift by however long their tests take."""
+        # (due, seq_idx, runs left or -1 forever)
+        timeline: List[Tuple[float, int, int]] = []
+        now = monotonic()
+        for seq_idx in seq_idxs:
+            repeat = self.spec.sequence[seq_idx].repeat
+            left = repeat.total if repeat else 1
+            runs, due = self.journal.progress(seq_idx)
+            if runs and left > 0:
+                left = max(0, left - runs)
+                if not left:
+                    continue
+            if runs:
+                log.info("Seq %d resumes after %d runs", seq_idx, runs)
+            heapq.heappush(timeline, (now + max(0, due - time()), seq_idx, left))
+
+        while timeline:
+            due, seq_idx, left = heapq.heappop(timeline)
+            self._sleep(due - monotonic())
+            seq = self.spec.sequence[seq_idx]
+            log.info("Executing seq %d", seq_idx)
+            with trace.span("sequence", seq=seq_idx):
+                self._run_tests(seq_idx, seq)
+            if trace_results():
+                trace.write(os.path.join(fiotest_dir(), "runner-trace.json"))
+            if left > 0:
+                left -= 1
+            if left == 0 or not seq.repeat:
+                self.journal.loop_done(seq_idx)
+                continue
+
+            now = monotonic()
+            delay = seq.repeat.delay_seconds
+            if seq.repeat.mode == "delay":
+                due = now + delay
+            elif delay <= 0 or due + delay >= now:
+                due += delay
+            else:
+                missed = int((now - due) // delay)
+                log.warning("Seq %d overran, skipping %d runs", seq_idx, missed)
+                due += (missed + 1) * delay
+            log.info("Repeating seq %d in %.1f seconds", seq_idx, max(0, due - now))
+            self.journal.loop_done(seq_idx, time() + due - now)
+            heapq.heappush(timeline, (due, seq_idx, left))
+
+    def _run_tests(self, seq_idx: int, seq: Sequence):
+        if seq.tests and seq.parallel > 1:
+            self._run_parallel(seq_idx, seq)
+        elif seq.tests:
+            for test_idx, test in enumerate(seq.tests):
+                self._assert_running()
+                if self.journal.completed(seq_idx, test_idx):
+                    continue
+                log.info("Executing test: %s", test.name)
+                self._run_once(seq_idx, test_idx, test, seq.batch)
+        if seq.batch:
+            self._flush_results()
@@ -1,12 +1,35 @@
-from typing import List, Optional
+from typing import List, Literal, Optional
 
 from pydantic import BaseModel
 
 
+class Limits(BaseModel):
+    """Resources a test may use, enforced with cgroup v2."""
+
+    cpu_weight: Optional[int]  # cpu.weight: 1-10000, 100 is everyone's default
+    cpu_max: Optional[float]  # CPUs worth of time per period, e.g. 0.5
+    memory_max: Optional[str]  # bytes, K/M/G suffixes allowed
+    io_weight: Optional[int]  # io.weight: 1-10000, 100 is everyone's default
+    nice: Optional[int]
+    ionice_class: Optional[Literal["realtime", "best-effort", "idle"]]
+    ionice_level: Optional[int]  # 0 (highest) to 7 for realtime and best-effort
+
+    def over(self, defaults: Optional["Limits"]) -> "Limits":
+        """These limits, with the ones they don't set taken from `defaults`."""
+        if not defaults:
+            return self
+        merged = defaults.dict(exclude_unset=True)
+        merged.update(self.dict(exclude_unset=True))
+        return Limits(**merged)
+
+
 class Test(BaseModel):
     name: str
     command: List[str]
     on_host: bool = False
+    # Tests in a parallel sequence sharing a tag never run at the same time
+    exclusive: List[str] = []
+    limits: Optional[Limits]
 
 
 class Reboot(BaseModel):
@@ -16,13 +39,28 @@ class Reboot(BaseModel):
 class Repeat(BaseModel):
     total: int = -1
     delay_seconds: int = 3600
+    # "delay" waits delay_seconds after a run finishes. "rate" starts a run
+    # every delay_seconds, skipping runs that would start too late.
+    mode: Literal["delay", "rate"] = "delay"
+    # Consecutive interleaved sequences share one timeline, each repeating
+    # on its own schedule.
+    interleave: bool = False
 
 
 class Sequence(BaseModel):
     tests: Optional[List[Test]]
     reboot: Optional[Reboot]
     repeat: Optional[Repeat]
+    parallel: int = 1  # how many tests may run at the same time
+    # report the sequence's results with as few gateway requests as possible
+    batch: bool = False
 
 
 class TestSpec(BaseModel):
     sequence: List[Sequence]
+    limits: Optional[Limits]  # defaults for every test
+
+    def test_limits(self, test: Test) -> Optional[Limits]:
+        if test.limits:
+            return test.limits.over(self.limits)
+        return self.limits
@@ -0,0 +1,318 @@
+"""Durable on-disk spool for test results that haven't reached the gateway.
+
+fio-test-wrap appends completed tests to an append-only journal and moves
+their artifacts next to it. A SpoolFlusher running in the fiotest container
+drains the journal in batches once the gateway can be reached.
+"""
+
+from contextlib import contextmanager
+import fcntl
+from itertools import groupby
+import json
+import logging
+import os
+import re
+from shutil import rmtree
+from threading import Event, Thread
+from time import time
+from typing import Dict, Iterator, List, Optional, Tuple
+from uuid import uuid4
+
+from fiotest.api import API, GatewayError, UploadResult
+from fiotest.jsonstream import iter_json
+
+log = logging.getLogger()
+MAX_ATTEMPTS = 5  # a record that fails this often for other reasons is dropped
+# how Spool.add starts the line of a completed test
+_COMPLETE = re.compile(rb'\{"op": "complete", "id": "([0-9a-f]+)"')
+
+
+class Spool:
+    def __init__(self, spool_dir: str):
+        self.spool_dir = spool_dir
+        self.journal = os.path.join(spool_dir, "journal")
+        os.makedirs(spool_dir, exist_ok=True)
+
+    def _append(self, record: dict):
+        with open(self.journal, "ab+") as f:
+            fcntl.flock(f, fcntl.LOCK_EX)
+            # A crash in the middle of a previous append could have left a
+            # partial line. Terminate it so this record stays parseable.
+            if f.seek(0, os.SEEK_END) > 0:
+                f.seek(-1, os.SEEK_END)
+                if f.read(1) != b"\n":
+                    f.write(b"\n")
+            # records can hold huge result sets, write them as they encode
+            for chunk in iter_json(record):
+                f.write(chunk.encode())
+            f.write(b"\n")
+            f.flush()
+            os.fsync(f.fileno())
+
+    @staticmethod
+    def _index(f) -> Dict[str, Tuple[int, dict]]:
+        """Map the ids of pending records to the offset of their "complete"
+           record and the updates recorded for them since. Completed tests
+           can carry huge result sets, so only their header is parsed."""
+        pending: Dict[str, Tuple[int, dict]] = {}
+        offset = 0
+        for line in f:
+            start, offset = offset, offset + len(line)
+            m = _COMPLETE.match(line)
+            if m:
+                if line.rstrip().endswith(b"}"):
+                    pending[m.group(1).decode()] = (start, {})
+                else:
+                    log.warning("Ignoring truncated spool record at %d", start)
+                continue
+            try:
+                rec = json.loads(line)
+            except ValueError:
+                log.warning("Ignoring corrupt spool record: %r", line[:200])
+                continue
+            if rec["op"] == "complete":
+                pending[rec["id"]] = (start, {})
+            elif rec["op"] == "started" and rec["id"] in pending:
+                pending[rec["id"]][1]["test_id"] = rec["test_id"]
+            elif rec["op"] == "uploads" and rec["id"] in pending:
+                pending[rec["id"]][1]["uploads"] = rec["uploads"]
+            elif rec["op"] == "attempt" and rec["id"] in pending:
+                updates = pending[rec["id"]][1]
+                updates["attempts"] = updates.get("attempts", 0) + 1
+            elif rec["op"] == "ack":
+                pending.pop(rec["id"], None)
+        return pending
+
+    @staticmethod
+    def _load(f, offset: int, updates: dict) -> Optional[dict]:
+        f.seek(offset)
+        line = f.readline()
+        try:
+            rec = json.loads(line)
+        except ValueError:
+            log.warning("Ignoring corrupt spool record at %d", offset)
+            return None
+        rec.update(updates)
+        return rec
+
+    def add(
+        self,
+        name: str,
+        target: str,
+        data: dict,
+        artifacts_dir: Optional[str] = None,
+        local_ts: Optional[float] = None,
+    ) -> str:
+        """Spool a completed test. The artifacts directory is moved into the
+           spool so it survives its test's temporary directory."""
+        rec_id = uuid4().hex
+        artifacts = None
+        if artifacts_dir and os.listdir(artifacts_dir):
+            artifacts = os.path.join(self.spool_dir, rec_id)
+            os.rename(artifacts_dir, artifacts)
+        record = {
+            "op": "complete",
+            "id": rec_id,
+            "name": name,
+            "target": target,
+            "local_ts": local_ts or time(),
+            "data": data,
+            "artifacts": artifacts,
+        }
+        self._append(record)
+        return rec_id
+
+    def pending(self, limit: Optional[int] = None) -> List[dict]:
+        """Return up to `limit` of the records not yet delivered in the
+           order they were spooled."""
+        try:
+            with open(self.journal, "rb") as f:
+                fcntl.flock(f, fcntl.LOCK_SH)
+                index = list(self._index(f).items())[:limit]
+                records = [self._load(f, *entry) for _, entry in index]
+        except FileNotFoundError:
+            return []
+        for (rec_id, _), rec in zip(index, records):
+            if not rec:
+                self._append({"op": "ack", "id": rec_id})  # nothing to deliver
+        return [rec for rec in records if rec]
+
+    def pending_ids(self) -> List[str]:
+        """Return the ids of the records not yet delivered, without loading
+           them."""
+        try:
+            with open(self.journal, "rb") as f:
+                fcntl.flock(f, fcntl.LOCK_SH)
+                return list(self._index(f))
+        except FileNotFoundError:
+            return []
+
+    def started(self, rec_id: str, test_id: str):
+        """Remember the test id the gateway handed out so a retry doesn't
+           create a second test."""
+        self._append({"op": "started", "id": rec_id, "test_id": test_id})
+
+    def retry_uploads(self, rec_id: str, urls: dict):
+        """Record that the test was completed and only the artifacts in
+           `urls` still have to be uploaded."""
+        self._append({"op": "uploads", "id": rec_id, "uploads": urls})
+
+    def attempted(self, rec_id: str):
+        """Record a failed attempt to deliver a record."""
+        self._append({"op": "attempt", "id": rec_id})
+
+    def ack(self, record: dict):
+        self._append({"op": "ack", "id": record["id"]})
+        if record["artifacts"]:
+            rmtree(record["artifacts"], ignore_errors=True)
+
+    @contextmanager
+    def flush_lock(self) -> Iterator[None]:
+        """Serialize delivery so two flushers never send the same record."""
+        with open(os.path.join(self.spool_dir, "flush.lock"), "w") as f:
+            fcntl.flock(f, fcntl.LOCK_EX)
+            yield
+
+    def compact(self):
+        """Truncate the journal once everything in it has been delivered."""
+        try:
+            with open(self.journal, "rb+") as f:
+                fcntl.flock(f, fcntl.LOCK_EX)
+                if not self._index(f):
+                    f.truncate(0)
+        except FileNotFoundError:
+            pass
+
+
+class SpoolFlusher:
+    def __init__(self, spool: Spool, api: API, interval: int = 30, batch: int = 20):
+        self.spool = spool
+        self.api = api
+        self.interval = interval
+        self.batch = batch
+        self.dropped = 0
+        self._wakeup = Event()
+        self.thread = Thread(target=self.run, daemon=True)
+
+    def start(self):
+        self.thread.start()
+
+    def kick(self):
+        """Flush as soon as possible rather than waiting out the interval."""
+        self._wakeup.set()
+
+    def run(self):
+        while True:
+            try:
+                # keep draining without a pause while there's a backlog
+                while self.flush() == self.batch:
+                    pass
+            except Exception:
+                log.exception("Unexpected error flushing result spool")
+            self._wakeup.wait(self.interval)
+            self._wakeup.clear()
+
+    def flush(self) -> int:
+        """Deliver up to one batch of spooled results. Returns the number of
+           results taken off the spool, delivered or dropped."""
+        self.dropped = 0
+        with self.spool.flush_lock():
+            batch = self.spool.pending(self.batch)
+            try:
+                self._deliver(batch)
+            except GatewayError as e:
+                # only transient errors get here, the rest wait for later
+                log.warning("Unable to deliver spooled results: %s", e)
+            remaining = set(self.spool.pending_ids())
+            if not remaining:
+                self.spool.compact()
+        done = len([rec for rec in batch if rec["id"] not in remaining])
+        if done > self.dropped:
+            log.info("Delivered %d spooled test results", done - self.dropped)
+        return done
+
+    def _deliver(self, records: List[dict]):
+        """Deliver records in order. Consecutive records for the same Target
+           are sent as one batch when the gateway supports it."""
+        for (target, started), group in groupby(
+            records, key=lambda r: (r["target"], bool(r.get("test_id")))
+        ):
+            recs = list(group)
+            completed = None
+            if not started:
+                try:
+                    # interrupted uploads are then resumed under the same test
+                    completed = self.api.complete_batch(recs, target, self._started)
+                except (Exception, SystemExit) as e:
+                    if isinstance(e, GatewayError) and e.transient:
+                        raise
+                    # sent one by one, only the record at fault is dropped
+                    log.warning("Unable to deliver spooled results as a batch: %s", e)
+            if completed:
+                for rec, (test_id, uploads) in zip(recs, completed):
+                    self._uploaded(rec, test_id, uploads)
+            else:
+                for rec in recs:
+                    self._attempt(rec)
+
+    def _attempt(self, rec: dict):
+        """Deliver a record, dropping it once the gateway refuses it for good
+           or it has failed MAX_ATTEMPTS times."""
+        try:
+            self._deliver_one(rec)
+        except GatewayError as e:
+            if e.transient:
+                raise
+            self._drop(rec, str(e))
+        except (Exception, SystemExit) as e:
+            attempts = rec.get("attempts", 0) + 1
+            if attempts >= MAX_ATTEMPTS:
+                self._drop(rec, "%s, after %d attempts" % (e, attempts))
+            else:
+                log.exception("Unable to deliver spooled result of %s", rec["name"])
+                self.spool.attempted(rec["id"])
+
+    def _drop(self, rec: dict, reason: str):
+        log.error("Dropping spooled result of %s: %s", rec["name"], reason)
+        self.spool.ack(rec)
+        self.dropped += 1
+
+    def _deliver_one(self, rec: dict):
+        if rec.get("uploads"):
+            # the gateway has the test's results, don't complete it again
+            uploads = self.api.upload_artifacts(
+                rec["test_id"], rec["artifacts"], rec["uploads"], rec["target"]
+            )
+            self._uploaded(rec, rec["test_id"], uploads)
+            return
+        test_id = rec.get("test_id")
+        if not test_id:
+            test_id = self.api.start_test(rec["name"], rec["target"])
+            self._started(rec, test_id)
+        uploads = self.api.complete_test(
+            test_id, rec["data"], rec["artifacts"], rec["target"]
+        )
+        self._uploaded(rec, test_id, uploads)
+
+    def _uploaded(self, rec: dict, test_id: str, uploads: List[UploadResult]):
+        """Ack a delivered record unless some of its artifacts failed to
+           upload for a reason that may go away. Only those are retried on a
+           later flush, resuming large artifacts where they stopped."""
+        for x in uploads:
+            if not x.ok and not x.retriable:
+                log.error(
+                    "Not retrying upload of %s of test %s: HTTP_%d",
+                    x.artifact,
+                    test_id,
+                    x.status_code,
+                )
+        retry = {x.artifact: x.urldata for x in uploads if x.retriable}
+        if not retry:
+            self.spool.ack(rec)
+            return
+        self.spool.retry_uploads(rec["id"], retry)
+        log.warning("Will retry uploading %s of test %s", ", ".join(retry), test_id)
+
+    def _started(self, rec: dict, test_id: str):
+        self.spool.started(rec["id"], test_id)
+        rec["test_id"] = test_id
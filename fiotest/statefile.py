@@ -0,0 +1,40 @@
+"""Small JSON state files shared by every fiotest process.
+
+Files are replaced atomically, so a process that dies while writing one
+never leaves a truncated file behind. Read-modify-write updates are made
+under an flock of a ".lock" file next to the state.
+"""
+
+from contextlib import contextmanager
+import fcntl
+import json
+import os
+from typing import Any, Iterator
+
+
+def read(path: str, default: Any = None) -> Any:
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except (FileNotFoundError, ValueError):
+        return default
+
+
+def write(path: str, data: Any):
+    tmp = path + ".tmp"
+    with open(tmp, "w") as f:
+        json.dump(data, f)
+    os.replace(tmp, path)
+
+
+@contextmanager
+def locked(path: str, default: Any) -> Iterator[Any]:
+    """Yield the state at `path`, or `default` if there is none, holding
+       the lock. Changes made to it are written back on exit."""
+    with open(path + ".lock", "w") as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        state = read(path, default)
+        before = json.dumps(state, sort_keys=True)
+        yield state
+        if json.dumps(state, sort_keys=True) != before:
+            write(path, state)
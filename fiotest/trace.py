@@ -0,0 +1,102 @@
+"""Lightweight timing spans for the phases of a test's lifecycle.
+
+Spans are kept in memory, only the most recent MAX_EVENTS of them, and
+can be written out in the Chrome trace event format. The files open in
+chrome://tracing and Perfetto. Timestamps are wall clock microseconds, so
+traces from the runner and from fio-test-wrap line up when loaded
+together.
+"""
+
+from collections import deque
+from contextlib import contextmanager
+import json
+import os
+import threading
+from time import monotonic, time
+from typing import Deque, Dict, Iterator
+
+MAX_EVENTS = 10000
+# the spans that make up a test's lifecycle, in order
+PHASES = (
+    "start_test",
+    "run",
+    "collect_results",
+    "spool",
+    "dedup",
+    "complete_test",
+    "complete_batch",
+    "upload_artifacts",
+)
+
+
+class Tracer:
+    def __init__(self, max_events: int = MAX_EVENTS):
+        self.events: Deque[dict] = deque(maxlen=max_events)
+        self.recorded = 0
+        self._lock = threading.Lock()
+
+    def add(self, name: str, start: float, seconds: float, args: dict):
+        event = {
+            "name": name,
+            "ph": "X",
+            "ts": int(start * 1e6),
+            "dur": int(seconds * 1e6),
+            "pid": os.getpid(),
+            "tid": threading.get_native_id(),
+            "args": args,
+        }
+        with self._lock:
+            self.events.append(event)
+            self.recorded += 1
+
+    @contextmanager
+    def span(self, name: str, **args) -> Iterator[dict]:
+        """Time the body of the with statement. The args dict is yielded so
+           the body can add details it learns along the way."""
+        start = time()
+        began = monotonic()
+        try:
+            yield args
+        except BaseException as e:
+            args["error"] = repr(e)
+            raise
+        finally:
+            self.add(name, start, monotonic() - began, args)
+
+    def write(self, path: str):
+        with self._lock:
+            events = list(self.events)
+            dropped = self.recorded - len(events)
+        tmp = path + ".tmp"
+        with open(tmp, "w") as f:
+            json.dump(
+                {
+                    "traceEvents": events,
+                    "displayTimeUnit": "ms",
+                    "otherData": {"dropped_events": dropped},
+                },
+                f,
+            )
+        os.replace(tmp, path)
+
+    def totals(self) -> Dict[str, float]:
+        """Seconds spent in the top level phases of this process' spans."""
+        with self._lock:
+            events = [e for e in self.events if e["pid"] == os.getpid()]
+        totals: Dict[str, float] = {}
+        for e in events:
+            if e["name"] in PHASES:
+                totals[e["name"]] = totals.get(e["name"], 0) + e["dur"] / 1e6
+        return {name: totals[name] for name in PHASES if name in totals}
+
+    def reset(self):
+        with self._lock:
+            self.events.clear()
+            self.recorded = 0
+
+
+_tracer = Tracer()
+span = _tracer.span
+write = _tracer.write
+totals = _tracer.totals
+reset = _tracer.reset
@@ -0,0 +1,195 @@
+"""A resident process that runs fio-test-wrap requests.
+
+Starting fio-test-wrap cold means importing pycurl and friends, parsing
+sota.toml and, on HSM backed devices, initializing the pkcs11 engine. That
+can take seconds on small boards. The worker does all of this once and
+then forks a child for each test. The child inherits the warm state.
+
+fio-test-wrap connects to the worker's Unix socket and passes its stdio
+over it with SCM_RIGHTS, so the test's output goes exactly where it would
+have gone had it run in-process. The child writes "pid <n>" and finally
+"rc <n>" back on the connection.
+
+This module is imported by the fio-test-wrap client, so it must only
+import the standard library at the top level.
+"""
+
+import json
+import logging
+import os
+import select
+import signal
+import socket
+import sys
+from threading import Thread
+import traceback
+from typing import List, Optional
+
+from fiotest import environment
+
+log = logging.getLogger()
+
+MAX_REQUEST_BYTES = 1024 * 1024
+
+
+class WrapWorker:
+    def __init__(self, socket_path: str, sota_dir: str):
+        self.socket_path = socket_path
+        self.sota_dir = sota_dir
+
+    def warm_up(self):
+        """Do the expensive parts of fio-test-wrap's startup once."""
+        from fiotest import wrap  # noqa: F401
+        from fiotest.gateway_client import DeviceGatewayClient
+
+        try:
+            # parses sota.toml and initializes the pkcs11 engine if needed
+            DeviceGatewayClient(self.sota_dir)
+        except Exception as e:
+            log.warning("Unable to initialize gateway client: %r", e)
+
+    def serve_forever(self):
+        try:
+            os.unlink(self.socket_path)
+        except FileNotFoundError:
+            pass
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        sock.bind(self.socket_path)
+        sock.listen(16)
+        # children are reaped by the kernel, clients get their exit code
+        signal.signal(signal.SIGCHLD, signal.SIG_IGN)
+        log.info("fio-test-wrap worker listening on %s", self.socket_path)
+        while True:
+            conn, _ = sock.accept()
+            try:
+                self._accept(sock, conn)
+            except Exception:
+                log.exception("Unable to handle fio-test-wrap request")
+            finally:
+                conn.close()
+
+    def _accept(self, sock: socket.socket, conn: socket.socket):
+        msg, fds, _, _ = socket.recv_fds(conn, MAX_REQUEST_BYTES, 3)
+        try:
+            buf = bytearray(msg)
+            while True:
+                data = conn.recv(MAX_REQUEST_BYTES)
+                if not data:
+                    break
+                buf += data
+            req = json.loads(buf)
+            if len(fds) != 3:
+                raise ValueError("Expected 3 fds for stdio, got %d" % len(fds))
+            if os.fork() == 0:
+                sock.close()
+                self._child(conn, fds, req)
+        finally:
+            for fd in fds:
+                os.close(fd)
+
+    @staticmethod
+    def _watch_client(conn: socket.socket):
+        """Kill the test if fio-test-wrap goes away without forwarding a
+           signal, e.g. when the runner had to SIGKILL it."""
+        poll = select.poll()
+        poll.register(conn, 0)  # only wakes up for POLLHUP and POLLERR
+        poll.poll()
+        os.killpg(0, signal.SIGKILL)
+
+    def _child(self, conn: socket.socket, fds: List[int], req: dict):
+        rc = 1
+        try:
+            # new session so the client can signal the test's whole tree
+            os.setsid()
+            signal.signal(signal.SIGCHLD, signal.SIG_DFL)
+            conn.sendall(b"pid %d\n" % os.getpid())
+            Thread(target=self._watch_client, args=(conn,), daemon=True).start()
+            for i, fd in enumerate(fds):
+                os.dup2(fd, i)
+            os.chdir(req["cwd"])
+            os.environ.clear()
+            os.environ.update(req["env"])
+            # log like a cold started fio-test-wrap would
+            log.handlers.clear()
+            log.setLevel(logging.WARNING)
+
+            from fiotest import wrap
+
+            wrap.main(
+                self.sota_dir,
+                req["test"],
+                req["cmd"],
+                environment.dry_run(),
+                req["bin_dir"],
+            )
+            rc = 0
+        except SystemExit as e:
+            if isinstance(e.code, int):
+                rc = e.code
+            elif e.code is not None:
+                print(e.code, file=sys.stderr)
+        except BaseException:
+            traceback.print_exc()
+        finally:
+            try:
+                sys.stdout.flush()
+                sys.stderr.flush()
+                conn.sendall(b"rc %d\n" % rc)
+            finally:
+                os._exit(rc)
+
+
+def run_in_worker(test: str, cmd: List[str], bin_dir: str) -> Optional[int]:
+    """Hand a test to the worker and return its exit code. Returns None if
+       there is no worker to run it."""
+    path = environment.worker_socket()
+    if not path:
+        return None
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        sock.connect(path)
+    except OSError:
+        sock.close()
+        return None
+
+    req = {
+        "test": test,
+        "cmd": cmd,
+        "cwd": os.getcwd(),
+        "env": dict(os.environ),
+        "bin_dir": bin_dir,
+    }
+    with sock:
+        socket.send_fds(sock, [json.dumps(req).encode()], [0, 1, 2])
+        sock.shutdown(socket.SHUT_WR)
+        reply = sock.makefile("rb")
+        line = reply.readline()
+        if not line.startswith(b"pid "):
+            return None  # the worker failed before starting the test
+        pid = int(line.split()[1])
+
+        def forward(signum, frame):
+            try:
+                os.killpg(pid, signum)
+            except ProcessLookupError:
+                pass
+
+        for sig in (signal.SIGTERM, signal.SIGINT, signal.SIGHUP):
+            signal.signal(sig, forward)
+
+        for line in reply:
+            if line.startswith(b"rc "):
+                return int(line.split()[1])
+    return 1  # the worker child died without reporting
+
+
+def main():
+    logging.basicConfig(level="INFO", format="%(asctime)s %(levelname)s: %(message)s")
+    sota_dir = os.environ.get("SOTA_DIR", "/var/sota")
+    worker = WrapWorker(environment.worker_socket(), sota_dir)
+    worker.warm_up()
+    worker.serve_forever()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,280 @@
+"""Running a test and reporting its results, the work behind fio-test-wrap."""
+
+import os
+from tempfile import mkdtemp
+from time import time
+from typing import Dict, Iterator, List, Optional
+from shutil import rmtree
+import subprocess
+import sys
+
+from fiotest import environment, trace
+from fiotest.api import API, GatewayError, status
+from fiotest.console import ConsoleCapture, open_log, read_excerpt
+from fiotest.journal import read_checkpoint, write_checkpoint
+from fiotest.logstream import LogStreamer
+from fiotest.metrics import attach as attach_series, collect as collect_metrics
+from fiotest.resources import ResourceMonitor, priority_args, wait
+from fiotest.spool import Spool
+
+
+def run(
+    artifacts_dir: str,
+    test_dir: str,
+    test_cmd: List[str],
+    monitor: Optional[ResourceMonitor] = None,
+    bin_dir: str = "/usr/local/bin",
+    live: float = 0,
+) -> str:
+    max_lines = 20
+    env = os.environ.copy()
+    env["PATH"] = bin_dir + ":" + os.environ["PATH"]
+    env["TEST_DIR"] = test_dir
+    env["ARTIFACTS_DIR"] = artifacts_dir
+    capture = None
+    try:
+        console = os.path.join(artifacts_dir, "console.log")
+        with open_log(console, environment.log_max_bytes()) as consolefd:
+            if monitor:
+                monitor.start()
+            p = subprocess.Popen(
+                test_cmd,
+                stderr=subprocess.STDOUT,
+                stdout=subprocess.PIPE,
+                env=env,
+                preexec_fn=monitor.cgroup.enter if monitor else None,
+            )
+            assert p.stdout  # for mypy
+            capture = ConsoleCapture(consolefd, sys.stdout.buffer, live=live)
+            capture.run(p.stdout.fileno())
+            p.returncode, ru = wait(p.pid)
+            if monitor:
+                monitor.stop(ru, capture.tail.lines(3))
+        if p.returncode != 0:
+            raise subprocess.CalledProcessError(p.returncode, test_cmd)
+    except Exception as e:
+        if monitor:
+            monitor.cgroup.remove()
+        buf = capture.tail.lines(max_lines) if capture else b""
+        return "%r\nLast %d lines of test:\n%s" % (
+            e,
+            max_lines,
+            buf.decode(errors="replace"),
+        )
+    return ""
+
+
+class Results:
+    """The results a test wrote into its results dir. They are read each
+       time the object is iterated, one at a time, so a test reporting tens
+       of thousands of results never has them all in memory at once."""
+
+    def __init__(
+        self,
+        results_dir: str,
+        artifacts_dir: Optional[str] = None,
+        usage: Optional[Dict[str, float]] = None,
+    ):
+        self.results_dir = results_dir
+        self.usage = usage
+        self.usage_ts = time()
+        with os.scandir(results_dir) as it:
+            self.names = [entry.name for entry in it]
+        self.names.sort(key=lambda x: float(x.split("-")[0]))  # sort by test time
+
+        if artifacts_dir and environment.attach_series():
+            # Done now since the artifacts are listed before results are sent
+            for res in self.names:
+                metrics = os.path.join(results_dir, res, "metrics")
+                if os.path.isdir(metrics):
+                    name = res.split("-", 1)[1]
+                    attach_series(metrics, artifacts_dir, "metrics-%s-" % name)
+
+    def _result(self, res: str) -> dict:
+        ts, name = res.split("-", 1)
+        result = {
+            "name": name,
+            "status": "PASSED",
+            "local_ts": float(ts),
+        }
+        failed = os.path.exists(os.path.join(self.results_dir, res, "failed"))
+        if failed:
+            result["status"] = "FAILED"
+            try:
+                log = os.path.join(self.results_dir, res, "log")
+                result["details"] = read_excerpt(log)
+            except FileNotFoundError:
+                pass
+
+        metrics = os.path.join(self.results_dir, res, "metrics")
+        if os.path.isdir(metrics):
+            result["metrics"] = collect_metrics(metrics)
+        skipped = os.path.exists(os.path.join(self.results_dir, res, "skipped"))
+        if skipped:
+            result["status"] = "SKIPPED"
+        return result
+
+    def __iter__(self) -> Iterator[dict]:
+        for res in self.names:
+            yield self._result(res)
+        if self.usage:
+            # What the whole test cost: CPU, peak memory, I/O and wall time
+            yield {
+                "name": "resources",
+                "status": "PASSED",
+                "local_ts": self.usage_ts,
+                "metrics": self.usage,
+            }
+
+
+def collect_results(
+    results_dir: str,
+    artifacts_dir: Optional[str] = None,
+    usage: Optional[Dict[str, float]] = None,
+) -> Results:
+    return Results(results_dir, artifacts_dir, usage)
+
+
+def main(
+    sota_dir: str,
+    test: str,
+    test_cmd: List[str],
+    dryrun: bool,
+    bin_dir: str = "/usr/local/bin",
+):
+    """Run a test and report its results. `bin_dir` holds the helpers like
+       fio-test-result that are put on the test's PATH."""
+    trace.reset()  # a worker child inherits its parent's spans
+    fiotest_dir = environment.fiotest_dir()
+    if not os.path.isdir(fiotest_dir):
+        status(
+            "WARNING: %s does not exist. "
+            "docker-compose.yml is likely missing bind mount" % fiotest_dir
+        )
+        os.mkdir(fiotest_dir)
+
+    api: Optional[API] = None
+    spool: Optional[Spool] = None
+    checkpoint = environment.test_checkpoint()
+    # the id the gateway gave this test before the runner was interrupted
+    resumed_id = read_checkpoint(checkpoint).get("test_id") if checkpoint else None
+    if dryrun or not environment.spool_mode():
+        api = API(sota_dir, dryrun)
+        if not dryrun and api.gateway.breaker.is_open():
+            status("Device gateway is unavailable, spooling results")
+            api = None
+    if api and resumed_id:
+        test_id = resumed_id
+        status("Resuming interrupted test: " + test_id)
+    elif api:
+        try:
+            test_id = api.start_test(test)
+        except GatewayError as e:
+            if not e.transient:
+                raise
+            status("%s, spooling results" % e)
+            api = None
+        else:
+            if checkpoint:
+                write_checkpoint(checkpoint, test_id=test_id)
+    if not api:
+        # Results are handed to the fiotest container's spool flusher so
+        # the test never has to wait on the gateway.
+        spool = Spool(os.path.join(fiotest_dir, "spool"))
+        target = API.target_name(sota_dir)
+        test_id = "SPOOLED"
+        started = time()
+    status("Starting test: " + test_id + " -> " + " ".join(test_cmd))
+
+    tmpdir = mkdtemp(prefix="fio-test", dir=fiotest_dir)
+    os.chmod(tmpdir, 0o777)
+    artifacts_dir = os.path.join(tmpdir, "artifacts")
+    results_dir = os.path.join(tmpdir, "results")
+    for x in (artifacts_dir, results_dir):
+        os.mkdir(x)
+        os.chmod(x, 0o777)
+
+    data: dict = {}
+    limits = environment.test_limits()
+    monitor = ResourceMonitor("fiotest-" + test, limits, environment.test_on_host())
+    test_cmd = priority_args(limits) + test_cmd
+    streamer = None
+    if api and not dryrun and environment.log_stream_seconds() > 0:
+        streamer = LogStreamer(
+            api.gateway,
+            api.url + "/" + test_id,
+            os.path.join(artifacts_dir, "console.log"),
+            api.uploads_dir,
+            environment.log_stream_seconds(),
+            environment.upload_chunk_bytes() or 8 * 1024 * 1024,
+        )
+        streamer.start()
+    with trace.span("run", test=test):
+        failure = run(
+            artifacts_dir,
+            results_dir,
+            test_cmd,
+            monitor,
+            bin_dir,
+            streamer.interval if streamer else 0,
+        )
+    if streamer:
+        streamed = streamer.finish()
+        status("Streamed %d bytes of console.log while the test ran" % streamed)
+    if failure:
+        data = {"status": "FAILED", "details": failure}
+
+    with trace.span("collect_results"):
+        usage = monitor.metrics
+        data["results"] = collect_results(results_dir, artifacts_dir, usage)
+    trace_file = os.path.join(artifacts_dir, "trace.json")
+    if environment.trace_results():
+        # attached to the result, so it ends before the results are sent
+        trace.write(trace_file)
+    try:
+        if spool:
+            with trace.span("spool"):
+                rec_id = spool.add(test, target, data, artifacts_dir, started)
+                if resumed_id:
+                    spool.started(rec_id, resumed_id)
+            status("Test results spooled for delivery")
+        else:
+            assert api  # for mypy
+            uploads = None
+            try:
+                uploads = api.complete_test(test_id, data, artifacts_dir)
+            except GatewayError as e:
+                if not e.transient:
+                    raise
+                status(str(e))
+            retry = {x.artifact: x.urldata for x in uploads or [] if x.retriable}
+            if uploads is None or retry:
+                # the spool flusher retries, resuming uploads where they stopped
+                spool = Spool(os.path.join(fiotest_dir, "spool"))
+                target = API.target_name(sota_dir)
+                if retry:
+                    data = {}  # the gateway has the results already
+                rec_id = spool.add(test, target, data, artifacts_dir)
+                spool.started(rec_id, test_id)
+                if retry:
+                    spool.retry_uploads(rec_id, retry)
+                status("Test results handed to the result spool")
+            gateway = api.gateway
+            status(
+                "Gateway requests: %d, TLS handshakes: %d, resumed bytes: %d"
+                % (gateway.requests, gateway.handshakes, gateway.resumed_bytes)
+            )
+        if checkpoint:
+            write_checkpoint(checkpoint, reported=True)
+        status(
+            "Time spent: "
+            + ", ".join("%s %.2fs" % (k, v) for k, v in trace.totals().items())
+        )
+    finally:
+        if environment.debug_mode():
+            if not os.path.isdir(artifacts_dir):
+                # the spool took the artifacts
+                trace_file = os.path.join(tmpdir, "trace.json")
+            trace.write(trace_file)  # the whole lifecycle, for local debugging
+        else:
+            rmtree(tmpdir)